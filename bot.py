@@ -1,21 +1,40 @@
+import time
+# startup time is measured from here, before the heavy imports below
+started_at = time.perf_counter()
 import asyncio
 import logging
 import re
+import base64
 import sys
+import signal
+import sqlite3
+import threading
+import dataclasses
+import bisect
+import random
+import heapq
+import itertools
+import contextvars
+from contextlib import contextmanager, asynccontextmanager
+from collections import OrderedDict, deque
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.enums import ParseMode
 from aiogram.filters import CommandStart
 from aiogram.utils.markdown import hbold
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, FSInputFile
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+from aiogram.types.update import UpdateTypeLookupError
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
 import aiohttp
+from aiohttp import web
 import openai
-from openai import OpenAI
+from openai import AsyncOpenAI
+import httpx
 import json
 import os
 from dotenv import load_dotenv
-import imgbbpy
 
 load_dotenv()
 
@@ -24,47 +43,259 @@ openai_base=os.getenv('OPENAI_BASE')
 TOKEN = os.getenv('TOKEN')
 IMGBB_API_KEY = os.getenv('IMGBB_API_KEY')
 userlog = os.getenv('USERLOG')
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', 60))
+OPENAI_CONCURRENCY = int(os.getenv('OPENAI_CONCURRENCY', 16))
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', '1') == '1'
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1.5))
+TELEGRAM_LIMIT = 4096
+SESSION_MAX_USERS = int(os.getenv('SESSION_MAX_USERS', 10000))
+SESSION_TTL = float(os.getenv('SESSION_TTL', 24 * 3600))
+SESSION_MAX_MESSAGES = int(os.getenv('SESSION_MAX_MESSAGES', 50))
+# memory, sqlite or redis
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'memory')
+SESSION_DB = os.getenv('SESSION_DB', 'sessions.db')
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+SESSION_FLUSH_INTERVAL = float(os.getenv('SESSION_FLUSH_INTERVAL', 2))
+# polling or webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 32))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+LOG_FLUSH_INTERVAL = float(os.getenv('LOG_FLUSH_INTERVAL', 10))
+LOG_FILE = os.getenv('LOG_FILE')
+CACHE_TTL = float(os.getenv('CACHE_TTL', 6 * 3600))
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 5000))
+RATE_QUEUE_SIZE = int(os.getenv('RATE_QUEUE_SIZE', 20))
+RATE_MAX_WAIT = float(os.getenv('RATE_MAX_WAIT', 10))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+IMAGE_N = int(os.getenv('IMAGE_N', 2))
+IMAGE_MAX_N = min(int(os.getenv('IMAGE_MAX_N', 4)), 10)
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 60))
+HTTP_LIMIT = int(os.getenv('HTTP_LIMIT', 100))
+HTTP_LIMIT_PER_HOST = int(os.getenv('HTTP_LIMIT_PER_HOST', 20))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 2))
+# json list of {"base": url, "key": api key, "models": [names]}, defaults to OPENAI_BASE
+OPENAI_ENDPOINTS = os.getenv('OPENAI_ENDPOINTS')
+HEDGE_REQUESTS = os.getenv('HEDGE_REQUESTS', '0') == '1'
+# share of upstream calls that may be hedged
+HEDGE_MAX_RATE = float(os.getenv('HEDGE_MAX_RATE', 0.05))
+OPENAI_RETRIES = int(os.getenv('OPENAI_RETRIES', 2))
+MODELS_FILE = os.getenv('MODELS_FILE')
+MODELS_RELOAD_INTERVAL = float(os.getenv('MODELS_RELOAD_INTERVAL', 30))
+JOB_DEADLINE = float(os.getenv('JOB_DEADLINE', 120))
+ADMIN_USERS = {int(user_id) for user_id in os.getenv('ADMIN_USERS', '').split(',') if user_id}
+PAID_USERS = {int(user_id) for user_id in os.getenv('PAID_USERS', '').split(',') if user_id}
+# opt-in cache of first-turn chat answers. a threshold below 1 also serves
+# answers to similar questions
+CHAT_CACHE = os.getenv('CHAT_CACHE', '0') == '1'
+CHAT_CACHE_THRESHOLD = float(os.getenv('CHAT_CACHE_THRESHOLD', 1))
+CHAT_CACHE_TTL = float(os.getenv('CHAT_CACHE_TTL', 24 * 3600))
+CHAT_CACHE_MAX_ENTRIES = int(os.getenv('CHAT_CACHE_MAX_ENTRIES', 5000))
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', 8))
+VISION_MAX_SIDE = int(os.getenv('VISION_MAX_SIDE', 1024))
+# imgbb uploads the photo and sends its url, inline sends a base64 data url
+VISION_IMAGE_MODE = os.getenv('VISION_IMAGE_MODE', 'imgbb' if IMGBB_API_KEY else 'inline')
 
-client = OpenAI(api_key=openai_key, base_url=openai_base)
-import requests
+# one pooled connection set shared by the chat, image and vision paths,
+# created on the first upstream call
+openai_http = None
 
-# add more as you like
-available_models = [
-"llama-3-70b",
-"gpt-3.5-turbo",
-"gpt-3.5-turbo-1106",
-"gpt-4",
-"gpt-4-turbo",
-]
+def get_openai_http():
+    global openai_http
+    if openai_http is None:
+        openai_http = httpx.AsyncClient(
+            timeout=OPENAI_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=OPENAI_CONCURRENCY * 2,
+                max_keepalive_connections=OPENAI_CONCURRENCY * 2,
+            ),
+        )
+    return openai_http
 
-image_models = [
-    'openjourney-xl' ,
-    'realisticVision' ,
-    'openjourney-v4' ,
-    'dreamshaper' ,
-    'absoluteReality' ,
-    'meinamix' ,
-    'deliberate' ,
-    'dall-e-3' ,
-    'deepfloyd-if' ,
-    'majicmixsombre', 
-    'pastelMixAnime' ,
-    'sdxl'
-]
-voice_d  = {
-    "adam": "pNInz6obpgDQGcFmaJgB",
-    "serena": "pMsXgVXv3BLzUgSXRplE",
-    "brian": "nPczCjzI2devNBz1zQrb",
-    "jessie": "t0jbNlBVZ17f02VDIeMI"
+def failover_error(e):
+    return isinstance(
+        e,
+        (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError),
+    )
+
+class Endpoint:
+    def __init__(self, base, key=None, models=None):
+        self.base = base
+        self.key = key or openai_key
+        self.models = set(models) if models else None
+        self._client = None
+        self.latency = 1.0
+        self.error_rate = 0.0
+        self.samples = deque(maxlen=100)
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = AsyncOpenAI(
+                api_key=self.key,
+                base_url=self.base,
+                timeout=OPENAI_TIMEOUT,
+                # the router retries and fails over itself
+                max_retries=0,
+                http_client=get_openai_http(),
+            )
+        return self._client
+
+    def serves(self, model):
+        return self.models is None or model in self.models
+
+    def score(self):
+        return self.latency * (1 + 10 * self.error_rate)
+
+    def record(self, seconds, ok):
+        self.error_rate = 0.9 * self.error_rate + (0.0 if ok else 0.1)
+        if ok:
+            self.latency = 0.8 * self.latency + 0.2 * seconds
+            self.samples.append(seconds)
+
+    def p95(self):
+        if len(self.samples) < 20:
+            return None
+        return sorted(self.samples)[int(len(self.samples) * 0.95)]
+
+class UpstreamRouter:
+    # tries endpoints healthiest first and fails over on connection, rate
+    # limit and server errors, then retries round robin with jittered backoff.
+    # with hedging on, a duplicate request goes to the next endpoint once the
+    # first has been slower than its own p95. hedges need a spare scheduler
+    # slot and are capped at max_hedge_rate of calls
+    def __init__(self, endpoints, hedge=False, max_hedge_rate=0.05, retries=2):
+        self.endpoints = endpoints
+        self.hedge = hedge
+        self.max_hedge_rate = max_hedge_rate
+        self.retries = retries
+        self.hedges = 0
+        self._hedge_budget = 1.0
+
+    def candidates(self, model):
+        endpoints = [e for e in self.endpoints if e.serves(model)] or self.endpoints
+        return sorted(endpoints, key=Endpoint.score)
+
+    async def _attempt(self, endpoint, call):
+        start = time.perf_counter()
+        try:
+            result = await call(endpoint.client)
+        except asyncio.CancelledError:
+            # a hedged loser, it was at least this slow
+            endpoint.record(time.perf_counter() - start, True)
+            raise
+        except Exception as e:
+            endpoint.record(time.perf_counter() - start, not failover_error(e))
+            raise
+        endpoint.record(time.perf_counter() - start, True)
+        return result
+
+    def _take_hedge(self):
+        if self._hedge_budget < 1 or not scheduler.try_acquire():
+            return False
+        self._hedge_budget -= 1
+        self.hedges += 1
+        return True
+
+    async def call(self, model, call, hedge=True):
+        candidates = self.candidates(model)
+        attempts = [candidates[i % len(candidates)] for i in range(len(candidates) + self.retries)]
+        hedge = hedge and self.hedge
+        if hedge:
+            self._hedge_budget = min(1.0, self._hedge_budget + self.max_hedge_rate)
+        error = None
+        i = 0
+        while i < len(attempts):
+            primary = attempts[i]
+            if i >= len(candidates):
+                await asyncio.sleep(random.uniform(0, 0.5 * 2 ** (i - len(candidates))))
+            i += 1
+            delay = primary.p95() if hedge and i < len(candidates) else None
+            pending = {asyncio.ensure_future(self._attempt(primary, call))}
+            try:
+                while pending:
+                    done, pending = await asyncio.wait(
+                        pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    if not done:
+                        delay = None
+                        if self._take_hedge():
+                            task = asyncio.ensure_future(self._attempt(attempts[i], call))
+                            task.add_done_callback(lambda _: scheduler.release())
+                            pending.add(task)
+                            i += 1
+                        continue
+                    for task in done:
+                        if task.exception() is None:
+                            return task.result()
+                        error = task.exception()
+                        if not failover_error(error):
+                            raise error
+                        logging.warning("Upstream %s failed for %s: %s", primary.base, model, error)
+            finally:
+                for task in pending:
+                    task.cancel()
+        raise error
+
+if OPENAI_ENDPOINTS:
+    endpoints = [Endpoint(**endpoint) for endpoint in json.loads(OPENAI_ENDPOINTS)]
+else:
+    endpoints = [Endpoint(openai_base)]
+upstream = UpstreamRouter(endpoints, HEDGE_REQUESTS, HEDGE_MAX_RATE, OPENAI_RETRIES)
+
+# add more as you like, or point MODELS_FILE at a json file of the same shape.
+# context is the prompt token budget, single_image models return one image per
+# request so n images are requested concurrently
+default_models = {
+    "chat": {
+        "llama-3-70b": {"context": 6000},
+        "gpt-3.5-turbo": {"context": 12000},
+        "gpt-3.5-turbo-1106": {"context": 12000},
+        "gpt-4": {"context": 6000},
+        "gpt-4-turbo": {"context": 100000},
+    },
+    "image": {
+        "openjourney-xl": {},
+        "realisticVision": {},
+        "openjourney-v4": {},
+        "dreamshaper": {},
+        "absoluteReality": {},
+        "meinamix": {},
+        "deliberate": {},
+        "dall-e-3": {"single_image": True},
+        "deepfloyd-if": {},
+        "majicmixsombre": {},
+        "pastelMixAnime": {},
+        "sdxl": {},
+    },
+    "tts": {
+        "adam": {"voice_id": "pNInz6obpgDQGcFmaJgB"},
+        "serena": {"voice_id": "pMsXgVXv3BLzUgSXRplE"},
+        "brian": {"voice_id": "nPczCjzI2devNBz1zQrb"},
+        "jessie": {"voice_id": "t0jbNlBVZ17f02VDIeMI"},
+    },
+    "vision": {
+        "gemini-pro-vision": {"context": 12000},
+        "llava-13b": {"context": 3000, "format": "llava"},
+    },
 }
 
-voice_models = ["adam", "serena", "brian", "jessie"]
+# requests per minute and burst size per user, then concurrent upstream calls
+family_rates = {"chat": (20, 5), "image": (4, 2), "tts": (6, 2), "vision": (6, 2)}
+family_ceilings = {"chat": 32, "image": 8, "tts": 8, "vision": 8}
+# share of upstream slots each workload gets when all of them are queued
+workload_weights = {"chat": 8, "vision": 3, "tts": 2, "image": 1}
 
-vision_models = ["gemini-pro-vision", "llava-13b"]
+DEFAULT_CONTEXT_TOKENS = 4000
+IMAGE_TOKENS = 300
 
 logging.basicConfig(level=logging.INFO)
 
-dp = Dispatcher()
 bot = Bot(TOKEN, parse_mode=ParseMode.HTML)
 
 class ImagePrompt(StatesGroup):
@@ -79,91 +310,1400 @@ class Viz(StatesGroup):
 class Intro(StatesGroup):
     waiting_for_reason = State()
 
-user_states = {}
+class Mode:
+    def __init__(self, name, title, menu, state=None, prompt=None):
+        self.name = name
+        self.title = title
+        self.menu = menu
+        self.state = state
+        self.prompt = prompt
 
-async def logme(username, model, text):
-    if userlog:
-        if username:
-            msg = str(username) + " " + str(model) +" "+ text
+modes = [
+    Mode("chat", "Chat", "text_nested_keyboard"),
+    Mode(
+        "image",
+        "Create Image",
+        "image_nested_keyboard",
+        ImagePrompt.waiting_for_text,
+        f"Enter text for the prompt (add n:3 for three images, at most {IMAGE_MAX_N}):",
+    ),
+    Mode(
+        "tts",
+        "Text-to-Speech (BROKEN)",
+        "audio_nested_keyboard",
+        Tts.waiting_for_tts,
+        "Limit is 50 characters. Enter the text for speech synthesis:",
+    ),
+    Mode(
+        "vision",
+        "Vision",
+        "vision_nested_keyboard",
+        Viz.waiting_for_vision,
+        "Upload a photo with your question as the caption ",
+    ),
+]
+
+class ModelRegistry:
+    # callback data resolves to (mode, options) with one dict lookup, and
+    # keyboards are built once per load instead of on every click
+    def __init__(self, modes, config, path=None):
+        self.modes = {mode.name: mode for mode in modes}
+        self.menus = {mode.menu: mode for mode in modes}
+        self.main_keyboard = types.InlineKeyboardMarkup(
+            inline_keyboard=[
+                [types.InlineKeyboardButton(text=mode.title, callback_data=mode.menu)]
+                for mode in modes
+            ]
+        )
+        self.path = path
+        self.mtime = None
+        self.load(config)
+        if path:
+            self.reload()
+
+    def load(self, config):
+        models = {}
+        keyboards = {}
+        for name, mode in self.modes.items():
+            entries = config.get(name, {})
+            for model, options in entries.items():
+                models[model] = (mode, options)
+            keyboards[mode.menu] = types.InlineKeyboardMarkup(
+                inline_keyboard=[
+                    [types.InlineKeyboardButton(text=model, callback_data=model)]
+                    for model in entries
+                ]
+            )
+        self.models, self.keyboards = models, keyboards
+
+    def reload(self):
+        mtime = os.path.getmtime(self.path)
+        if mtime == self.mtime:
+            return False
+        with open(self.path) as models_file:
+            self.load(json.load(models_file))
+        self.mtime = mtime
+        logging.info("Loaded %d models from %s", len(self.models), self.path)
+        return True
+
+    def mode_of(self, model):
+        entry = self.models.get(model)
+        return entry[0] if entry else None
+
+    def option(self, model, name, default=None):
+        entry = self.models.get(model)
+        return entry[1].get(name, default) if entry else default
+
+registry = ModelRegistry(modes, default_models, MODELS_FILE)
+
+async def watch_models():
+    while True:
+        await asyncio.sleep(MODELS_RELOAD_INTERVAL)
+        try:
+            registry.reload()
+        except Exception as e:
+            logging.exception("Error reloading %s: %s", MODELS_FILE, e)
+
+finish_dialog_markup = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text="Finish Dialogue")]], resize_keyboard=True
+)
+
+def image_url_of(part):
+    url = part.get("image_url") or ""
+    return url.get("url", "") if isinstance(url, dict) else url
+
+def count_tokens(message):
+    # rough 4 characters per token estimate, computed once per message. a
+    # data url costs its size to resend, so it counts at least that much
+    content = message["content"] or ""
+    if isinstance(content, str):
+        return 4 + len(content) // 4
+    tokens = 4
+    for part in content:
+        if part.get("type") == "image_url":
+            url = image_url_of(part)
+            tokens += max(IMAGE_TOKENS, len(url) // 4) if url.startswith("data:") else IMAGE_TOKENS
+        else:
+            tokens += len(part.get("text") or "") // 4
+    return tokens
+
+def stored_message(message):
+    # inline images are only sent with the turn they arrived in, the history
+    # keeps a placeholder so they are not resent and persisted on every turn
+    content = message["content"]
+    if isinstance(content, str):
+        return {**message, "content": "[image]"} if content.startswith("data:") else message
+    parts = [
+        {"type": "text", "text": "[image]"}
+        if part.get("type") == "image_url" and image_url_of(part).startswith("data:")
+        else part
+        for part in content
+    ]
+    return {**message, "content": parts}
+
+def context_budget(model):
+    return registry.option(model, "context", DEFAULT_CONTEXT_TOKENS)
+
+class Session:
+    __slots__ = ("model", "button_sent", "conversation", "tokens", "token_total", "touched", "active")
+
+    def __init__(self, model=None, button_sent=False):
+        self.model = model
+        self.button_sent = button_sent
+        self.conversation = []
+        self.tokens = []
+        self.token_total = 0
+        self.touched = time.monotonic()
+        self.active = True
+
+    def to_dict(self):
+        return {
+            "model": self.model,
+            "button_sent": self.button_sent,
+            "conversation": self.conversation,
+            "tokens": self.tokens,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        session = cls(data["model"], data["button_sent"])
+        session.conversation = data["conversation"]
+        session.tokens = data["tokens"]
+        session.token_total = sum(session.tokens)
+        return session
+
+    def add(self, *messages):
+        for message in messages:
+            tokens = count_tokens(message)
+            self.conversation.append(message)
+            self.tokens.append(tokens)
+            self.token_total += tokens
+        # drop the oldest turns until the history fits, always keeping the latest
+        budget = context_budget(self.model)
+        drop = max(0, len(self.conversation) - SESSION_MAX_MESSAGES)
+        total = self.token_total - sum(self.tokens[:drop])
+        while total > budget and drop < len(self.conversation) - 1:
+            total -= self.tokens[drop]
+            drop += 1
+        if drop:
+            del self.conversation[:drop]
+            del self.tokens[:drop]
+            self.token_total = total
+
+class SqliteBackend:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("create table if not exists sessions (user_id integer primary key, data text)")
+        self.db.execute("create table if not exists fsm (key text primary key, state text, data text)")
+        self.db.commit()
+        self.lock = threading.Lock()
+
+    def _fetch(self, sql, args):
+        with self.lock:
+            return self.db.execute(sql, args).fetchone()
+
+    def _write(self, sql, rows, delete_sql=None, deletes=()):
+        with self.lock:
+            self.db.executemany(sql, rows)
+            if delete_sql:
+                self.db.executemany(delete_sql, deletes)
+            self.db.commit()
+
+    async def load(self, user_id):
+        row = await asyncio.to_thread(
+            self._fetch, "select data from sessions where user_id = ?", (user_id,)
+        )
+        return json.loads(row[0]) if row else None
+
+    async def save_many(self, sessions):
+        rows = [(user_id, json.dumps(data)) for user_id, data in sessions.items()]
+        await asyncio.to_thread(
+            self._write, "insert or replace into sessions values (?, ?)", rows
+        )
+
+    async def load_fsm(self, key):
+        row = await asyncio.to_thread(
+            self._fetch, "select state, data from fsm where key = ?", (key,)
+        )
+        return {"state": row[0], "data": json.loads(row[1])} if row else None
+
+    async def save_fsm_many(self, records):
+        rows = []
+        deletes = []
+        for key, record in records.items():
+            if record["state"] is None and not record["data"]:
+                deletes.append((key,))
+            else:
+                rows.append((key, record["state"], json.dumps(record["data"])))
+        await asyncio.to_thread(
+            self._write,
+            "insert or replace into fsm values (?, ?, ?)",
+            rows,
+            "delete from fsm where key = ?",
+            deletes,
+        )
+
+    def _close(self):
+        with self.lock:
+            self.db.close()
+
+    async def close(self):
+        await asyncio.to_thread(self._close)
+
+class RedisBackend:
+    def __init__(self, url):
+        import redis.asyncio
+
+        self.redis = redis.asyncio.Redis.from_url(url)
+
+    async def load(self, user_id):
+        raw = await self.redis.get(f"session:{user_id}")
+        return json.loads(raw) if raw else None
+
+    async def save_many(self, sessions):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id, data in sessions.items():
+                pipe.set(f"session:{user_id}", json.dumps(data), ex=int(SESSION_TTL))
+            await pipe.execute()
+
+    async def load_fsm(self, key):
+        raw = await self.redis.get(f"fsm:{key}")
+        return json.loads(raw) if raw else None
+
+    async def save_fsm_many(self, records):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key, record in records.items():
+                if record["state"] is None and not record["data"]:
+                    pipe.delete(f"fsm:{key}")
+                else:
+                    pipe.set(f"fsm:{key}", json.dumps(record), ex=int(SESSION_TTL))
+            await pipe.execute()
+
+    async def close(self):
+        await self.redis.aclose()
+
+class WriteBehindStorage(BaseStorage):
+    # fsm storage with the same write-behind as the sessions: reads are served
+    # from memory after the first load, writes are batched by flush() to the
+    # sqlite or redis backend
+    def __init__(self, backend):
+        self.backend = backend
+        self._records = {}
+        self._dirty = set()
+
+    def _key(self, key):
+        return ":".join(str(part) for part in dataclasses.astuple(key))
+
+    async def _record(self, key):
+        name = self._key(key)
+        record = self._records.get(name)
+        if record is None:
+            record = await self.backend.load_fsm(name) or {"state": None, "data": {}}
+            record = self._records.setdefault(name, record)
+        return name, record
+
+    async def set_state(self, key, state=None):
+        name, record = await self._record(key)
+        record["state"] = state.state if isinstance(state, State) else state
+        self._dirty.add(name)
+
+    async def get_state(self, key):
+        name, record = await self._record(key)
+        return record["state"]
+
+    async def set_data(self, key, data):
+        name, record = await self._record(key)
+        record["data"] = data.copy()
+        self._dirty.add(name)
+
+    async def get_data(self, key):
+        name, record = await self._record(key)
+        return record["data"].copy()
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        batch = {}
+        for name in self._dirty:
+            record = self._records[name]
+            batch[name] = {"state": record["state"], "data": record["data"].copy()}
+        dirty, self._dirty = self._dirty, set()
+        try:
+            await self.backend.save_fsm_many(batch)
+        except Exception:
+            # written again by the next flush
+            self._dirty |= dirty
+            raise
+        for name in dirty - self._dirty:
+            record = self._records.get(name)
+            if record is not None and record["state"] is None and not record["data"]:
+                del self._records[name]
+
+    async def close(self):
+        await self.flush()
+
+class SessionStore:
+    # least recently used sessions sit at the front of the OrderedDict, so
+    # both the size cap and the idle ttl only ever evict from the front.
+    # with a backend, sessions are loaded lazily on a user's first update and
+    # written back in batches by flush()
+    def __init__(self, max_users, ttl, backend=None):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.backend = backend
+        self._sessions = OrderedDict()
+        self._dirty = set()
+        self._flushing = set()
+        self._evicted = {}
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, user_id):
+        self._expire()
+        return user_id in self._sessions
+
+    def get(self, user_id):
+        self._expire()
+        session = self._sessions.get(user_id)
+        if session is not None:
+            session.touched = time.monotonic()
+            self._sessions.move_to_end(user_id)
+        return session
+
+    def reset(self, user_id):
+        previous = self._sessions.get(user_id)
+        if previous is not None:
+            previous.active = False
+        session = Session()
+        self._insert(user_id, session)
+        self.mark_dirty(user_id)
+        return session
+
+    async def load(self, user_id):
+        if self.backend is None or user_id in self._sessions:
+            return
+        session = self._evicted.get(user_id)
+        if session is None:
+            data = await self.backend.load(user_id)
+            if data is None or user_id in self._sessions:
+                return
+            session = Session.from_dict(data)
+        session.touched = time.monotonic()
+        self._insert(user_id, session)
+
+    def mark_dirty(self, user_id):
+        if self.backend is not None and user_id in self._sessions:
+            self._dirty.add(user_id)
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        batch = {}
+        for user_id in self._dirty:
+            session = self._sessions.get(user_id) or self._evicted.get(user_id)
+            if session is not None:
+                batch[user_id] = session.to_dict()
+        self._flushing, self._dirty = self._dirty, set()
+        try:
+            await self.backend.save_many(batch)
+        except Exception:
+            # written again by the next flush, evicted sessions stay in memory until then
+            self._dirty |= self._flushing
+            raise
+        finally:
+            flushed, self._flushing = self._flushing, set()
+        for user_id in flushed - self._dirty:
+            self._evicted.pop(user_id, None)
+
+    def _insert(self, user_id, session):
+        self._sessions[user_id] = session
+        self._sessions.move_to_end(user_id)
+        self._expire()
+        while len(self._sessions) > self.max_users:
+            self._drop()
+
+    def _expire(self):
+        deadline = time.monotonic() - self.ttl
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if session.touched >= deadline:
+                break
+            self._drop()
+
+    def _drop(self):
+        # keep unflushed sessions around until a flush has written them out
+        user_id, session = self._sessions.popitem(last=False)
+        if user_id in self._dirty or user_id in self._flushing:
+            self._evicted[user_id] = session
+
+if SESSION_BACKEND == "sqlite":
+    session_backend = SqliteBackend(SESSION_DB)
+    fsm_storage = WriteBehindStorage(session_backend)
+elif SESSION_BACKEND == "redis":
+    session_backend = RedisBackend(REDIS_URL)
+    fsm_storage = WriteBehindStorage(session_backend)
+else:
+    session_backend = None
+    fsm_storage = MemoryStorage()
+
+user_states = SessionStore(SESSION_MAX_USERS, SESSION_TTL, session_backend)
+dp = Dispatcher(storage=fsm_storage)
+
+current_user = contextvars.ContextVar("current_user", default=None)
+
+class Lifecycle:
+    # tracks handler tasks so shutdown can let in-flight replies finish.
+    # stopping ends the intake of updates, closing ends the background loops
+    def __init__(self, drain_timeout, started_at):
+        self.drain_timeout = drain_timeout
+        self.started_at = started_at
+        self.startup_seconds = None
+        self.stopping = asyncio.Event()
+        self.closing = asyncio.Event()
+        self.inflight = set()
+        self.drained = 0
+        self.cancelled = 0
+        self.drain_seconds = None
+
+    def started(self):
+        self.startup_seconds = time.perf_counter() - self.started_at
+        logging.info("Started in %.3fs", self.startup_seconds)
+
+    async def pause(self, seconds):
+        # sleeps between rounds of a background loop, False once closing
+        try:
+            await asyncio.wait_for(self.closing.wait(), seconds)
+        except asyncio.TimeoutError:
+            return True
+        return False
+
+    def track(self):
+        task = asyncio.current_task()
+        self.inflight.add(task)
+        return task
+
+    async def drain(self, extra=()):
+        start = time.perf_counter()
+        pending = (self.inflight | set(extra)) - {asyncio.current_task()}
+        done = set()
+        if pending:
+            done, pending = await asyncio.wait(pending, timeout=self.drain_timeout)
+        for task in pending:
+            task.cancel()
+        self.drained += len(done)
+        self.cancelled += len(pending)
+        self.drain_seconds = time.perf_counter() - start
+        logging.info(
+            "Drained %d in-flight handlers in %.3fs, cancelled %d",
+            len(done), self.drain_seconds, len(pending),
+        )
+
+lifecycle = Lifecycle(DRAIN_TIMEOUT, started_at)
+
+class UserLocks:
+    # polling runs every update in its own task, a lock per user keeps one
+    # user's updates from reading and writing the same history at once
+    def __init__(self):
+        self._locks = {}
+
+    @asynccontextmanager
+    async def hold(self, user_id):
+        entry = self._locks.setdefault(user_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[user_id]
+
+user_locks = UserLocks()
+
+def finishes_dialogue(update: types.Update):
+    text = update.message.text if update.message else None
+    return text is not None and text.lower() == "finish dialogue"
+
+@dp.update.outer_middleware()
+async def session_middleware(handler, event, data):
+    user = data.get("event_from_user")
+    if user is None:
+        return await handler(event, data)
+    current_user.set(user.id)
+    task = lifecycle.track()
+    try:
+        await user_states.load(user.id)
+        return await handler(event, data)
+    except JobDropped as e:
+        chat = data.get("event_chat")
+        if e.finished:
+            logging.info("Dropped upstream job for %s, dialogue already finished", user.id)
+        else:
+            logging.info("Dropped upstream job for %s, waited more than %ss", user.id, scheduler.deadline)
+            if chat is not None:
+                await bot.send_message(chat.id, "The bot is busy right now, please try again in a moment.")
+    finally:
+        user_states.mark_dirty(user.id)
+        lifecycle.inflight.discard(task)
+
+class RateLimiter:
+    # token bucket per user and model family. requests over the limit wait
+    # in a short fifo queue for up to RATE_MAX_WAIT before being rejected.
+    # it runs on the update before the user lock, so a burst is counted as
+    # it arrives instead of one message at a time
+    def __init__(self, rates, ceilings, queue_size, max_wait):
+        self.rates = rates
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.slots = {family: asyncio.Semaphore(limit) for family, limit in ceilings.items()}
+        self.waiting = dict.fromkeys(ceilings, 0)
+        self.rejected = dict.fromkeys(ceilings, 0)
+        self._buckets = OrderedDict()
+
+    def _reserve(self, user_id, family):
+        per_minute, burst = self.rates[family]
+        rate = per_minute / 60
+        now = time.monotonic()
+        key = (user_id, family)
+        tokens, updated = self._buckets.pop(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        wait = max(0.0, (1 - tokens) / rate)
+        # a request that has to wait needs room in the queue, a rejected one
+        # takes no token from the bucket
+        if wait > self.max_wait or (wait and self.waiting[family] >= self.queue_size):
+            self._buckets[key] = (tokens, now)
+            return None
+        self._buckets[key] = (tokens - 1, now)
+        while len(self._buckets) > SESSION_MAX_USERS:
+            self._buckets.popitem(last=False)
+        return wait
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        message = event.message
+        if user is None or message is None:
+            return await handler(event, data)
+        session = user_states.get(user.id)
+        mode = registry.mode_of(session.model) if session else None
+        family = mode.name if mode else None
+        text = message.text or message.caption or ""
+        if family is None or text.lower() == "finish dialogue":
+            return await handler(event, data)
+        wait = self._reserve(user.id, family)
+        if wait is None:
+            self.rejected[family] += 1
+            await message.reply("Too many requests, please wait a moment and try again.")
+            return
+        self.waiting[family] += 1
+        try:
+            if wait:
+                await asyncio.sleep(wait)
+            await self.slots[family].acquire()
+        finally:
+            self.waiting[family] -= 1
+        try:
+            return await handler(event, data)
+        finally:
+            self.slots[family].release()
+
+rate_limiter = RateLimiter(family_rates, family_ceilings, RATE_QUEUE_SIZE, RATE_MAX_WAIT)
+dp.update.outer_middleware(rate_limiter)
+
+@dp.update.outer_middleware()
+async def ordered_middleware(handler, event, data):
+    user = data.get("event_from_user")
+    # finishing does not wait its turn, it drops the job still queued
+    if user is None or finishes_dialogue(event):
+        return await handler(event, data)
+    async with user_locks.hold(user.id):
+        return await handler(event, data)
+
+async def flush_state():
+    if session_backend is not None:
+        await user_states.flush()
+    if isinstance(fsm_storage, WriteBehindStorage):
+        await fsm_storage.flush()
+
+async def write_behind():
+    while await lifecycle.pause(SESSION_FLUSH_INTERVAL):
+        try:
+            await flush_state()
+        except Exception as e:
+            logging.exception("Error flushing sessions: %s", e)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+class Counter:
+    # counted with inc(), or read at scrape time from fn like a Gauge
+    def __init__(self, name, doc, labels=(), fn=None):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.fn = fn
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} counter"
+        values = self.fn() if self.fn else self.values
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            if not isinstance(labels, tuple):
+                labels = (labels,)
+            yield f"{self.name}{format_labels(self.labels, labels)} {value}"
+
+class Gauge:
+    # read at scrape time, fn returns a number or a {labels: number} dict
+    def __init__(self, name, doc, fn, labels=()):
+        self.name = name
+        self.doc = doc
+        self.fn = fn
+        self.labels = labels
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} gauge"
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            if not isinstance(labels, tuple):
+                labels = (labels,)
+            yield f"{self.name}{format_labels(self.labels, labels)} {value}"
+
+class Histogram:
+    # one bisect and two additions per observation, buckets are only
+    # accumulated when scraped
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                bucket_labels = format_labels(self.labels + ("le",), labels + (bound,))
+                yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labels, labels)} {total}"
+            yield f"{self.name}_count{format_labels(self.labels, labels)} {cumulative}"
+
+handler_seconds = Histogram("bot_handler_seconds", "Time spent in each handler.", ("handler",))
+stage_seconds = Histogram("bot_stage_seconds", "Time spent in each handler stage.", ("handler", "stage"))
+upstream_seconds = Histogram("bot_upstream_seconds", "Upstream call latency per model.", ("model",))
+upstream_errors = Counter("bot_upstream_errors_total", "Failed upstream calls per model.", ("model",))
+upstream_first_chunk_seconds = Histogram(
+    "bot_upstream_first_chunk_seconds", "Time to the first streamed chunk per model.", ("model",)
+)
+loop_lag_seconds = Histogram("bot_event_loop_lag_seconds", "Event loop scheduling lag.")
+metrics = [
+    handler_seconds,
+    stage_seconds,
+    upstream_seconds,
+    upstream_errors,
+    upstream_first_chunk_seconds,
+    loop_lag_seconds,
+    Gauge("bot_active_sessions", "Sessions held in memory.", lambda: len(user_states)),
+    Gauge("bot_rate_limit_waiting", "Requests queued by the rate limiter.", lambda: rate_limiter.waiting, ("family",)),
+    Counter("bot_rate_limit_rejected_total", "Requests rejected by the rate limiter.", ("family",), lambda: rate_limiter.rejected),
+    Counter("bot_cache_hits_total", "Response cache hits.", fn=lambda: response_cache.hits),
+    Counter("bot_cache_misses_total", "Response cache misses.", fn=lambda: response_cache.misses),
+    Counter("bot_upstream_calls_total", "Upstream calls started by single-flight.", fn=lambda: single_flight.calls),
+    Counter(
+        "bot_upstream_coalesced_total",
+        "Requests that joined an in-flight upstream call.",
+        fn=lambda: single_flight.coalesced,
+    ),
+    Gauge(
+        "bot_endpoint_latency_seconds",
+        "Smoothed latency per upstream endpoint.",
+        lambda: {e.base: e.latency for e in upstream.endpoints},
+        ("endpoint",),
+    ),
+    Gauge(
+        "bot_endpoint_error_rate",
+        "Smoothed error rate per upstream endpoint.",
+        lambda: {e.base: e.error_rate for e in upstream.endpoints},
+        ("endpoint",),
+    ),
+    Counter("bot_answer_cache_hits_total", "First-turn chat answers served from cache.", fn=lambda: answer_cache.hits),
+    Counter("bot_answer_cache_misses_total", "First-turn chat answers not in cache.", fn=lambda: answer_cache.misses),
+    Counter(
+        "bot_answer_cache_saved_seconds_total",
+        "Upstream time saved by cached chat answers.",
+        fn=lambda: answer_cache.saved_seconds,
+    ),
+    Gauge("bot_startup_seconds", "Time from import to ready.", lambda: lifecycle.startup_seconds or 0),
+    Gauge("bot_inflight_handlers", "Handlers currently running.", lambda: len(lifecycle.inflight)),
+    Gauge("bot_log_queue_size", "User log events waiting to be sent.", lambda: log_queue.qsize()),
+    Counter("bot_log_dropped_total", "User log events dropped because the queue was full.", fn=lambda: log_dropped),
+]
+
+@contextmanager
+def timed(handler, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, handler, stage)
+
+@contextmanager
+def upstream_timer(model, clock=None):
+    # clock, when given, is a {"seconds": float} the elapsed time is added to
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        upstream_errors.inc(str(model))
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        upstream_seconds.observe(elapsed, str(model))
+        if clock is not None:
+            clock["seconds"] += elapsed
+
+async def metrics_middleware(handler, event, data):
+    start = time.perf_counter()
+    try:
+        return await handler(event, data)
+    finally:
+        name = data["handler"].callback.__name__
+        handler_seconds.observe(time.perf_counter() - start, name)
+
+dp.message.middleware(metrics_middleware)
+dp.callback_query.middleware(metrics_middleware)
+
+async def measure_loop_lag(interval=0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        loop_lag_seconds.observe(max(0.0, loop.time() - start - interval))
+
+async def serve_metrics(request):
+    lines = [line for metric in metrics for line in metric.render()]
+    return web.Response(text="\n".join(lines) + "\n", content_type="text/plain")
+
+async def start_metrics_server():
+    app = web.Application()
+    app.router.add_get("/metrics", serve_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    return runner
+
+class JobDropped(Exception):
+    # finished is False when the job only waited past the deadline
+    def __init__(self, finished=True):
+        super().__init__()
+        self.finished = finished
+
+def user_priority(user_id):
+    if user_id in ADMIN_USERS:
+        return 0
+    if user_id in PAID_USERS:
+        return 1
+    return 2
+
+class JobScheduler:
+    # hands out upstream slots. each workload has its own queue ordered by
+    # user tier, and queues are served by weighted fair (stride) scheduling.
+    # jobs whose dialogue was finished or that waited past the deadline are
+    # dropped when they reach the front instead of calling upstream
+    def __init__(self, capacity, weights, deadline):
+        self.free = capacity
+        self.weights = weights
+        self.deadline = deadline
+        self.queues = {workload: [] for workload in weights}
+        self.vtime = dict.fromkeys(weights, 0.0)
+        self.clock = 0.0
+        self.dropped = dict.fromkeys(weights, 0)
+        self.wait_seconds = Histogram(
+            "bot_queue_wait_seconds", "Time upstream jobs wait for a slot.", ("workload",)
+        )
+        self._seq = itertools.count()
+
+    @asynccontextmanager
+    async def slot(self, workload):
+        await self.acquire(workload if workload in self.queues else "chat")
+        try:
+            yield
+        finally:
+            self.release()
+
+    def try_acquire(self):
+        # a spare slot that never queues, used for hedged requests
+        if self.free > 0 and not any(self.queues.values()):
+            self.free -= 1
+            return True
+        return False
+
+    async def acquire(self, workload):
+        user_id = current_user.get()
+        if self.free > 0 and not any(self.queues.values()):
+            self.free -= 1
+            self.wait_seconds.observe(0.0, workload)
+            return
+        queue = self.queues[workload]
+        if not queue:
+            self.vtime[workload] = max(self.vtime[workload], self.clock)
+        future = asyncio.get_running_loop().create_future()
+        session = user_states.get(user_id) if user_id is not None else None
+        job = (user_priority(user_id), next(self._seq), time.monotonic(), future, session)
+        heapq.heappush(queue, job)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self.release()
+            raise
+
+    def release(self):
+        self.free += 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.free > 0:
+            active = [workload for workload, queue in self.queues.items() if queue]
+            if not active:
+                return
+            workload = min(active, key=self.vtime.__getitem__)
+            priority, seq, start, future, session = heapq.heappop(self.queues[workload])
+            if future.cancelled():
+                continue
+            self.clock = self.vtime[workload]
+            self.vtime[workload] += 1 / self.weights[workload]
+            finished = session is not None and not session.active
+            if finished or time.monotonic() - start > self.deadline:
+                self.dropped[workload] += 1
+                future.set_exception(JobDropped(finished))
+                continue
+            self.free -= 1
+            self.wait_seconds.observe(time.monotonic() - start, workload)
+            future.set_result(None)
+
+scheduler = JobScheduler(OPENAI_CONCURRENCY, workload_weights, JOB_DEADLINE)
+metrics.append(scheduler.wait_seconds)
+metrics.append(
+    Gauge(
+        "bot_queue_depth",
+        "Upstream jobs waiting per workload.",
+        lambda: {workload: len(queue) for workload, queue in scheduler.queues.items()},
+        ("workload",),
+    )
+)
+metrics.append(
+    Counter("bot_jobs_dropped_total", "Upstream jobs dropped before running.", ("workload",), lambda: scheduler.dropped)
+)
+
+def workload_of(model):
+    mode = registry.mode_of(model)
+    return mode.name if mode else "chat"
+
+async def chat_completion(clock=None, **kwargs):
+    async with scheduler.slot(workload_of(kwargs.get("model"))):
+        with upstream_timer(kwargs.get("model"), clock):
+            return await upstream.call(
+                kwargs.get("model"), lambda client: client.chat.completions.create(**kwargs)
+            )
+
+async def chat_stream(clock=None, **kwargs):
+    # only time spent waiting on upstream is observed, not the telegram
+    # edits the consumer makes between chunks
+    model = str(kwargs.get("model"))
+    async with scheduler.slot(workload_of(kwargs.get("model"))):
+        start = time.perf_counter()
+        waited = 0.0
+        first = True
+        try:
+            stream = await upstream.call(
+                kwargs.get("model"),
+                lambda client: client.chat.completions.create(stream=True, **kwargs),
+                hedge=False,
+            )
+            waited = time.perf_counter() - start
+            chunks = stream.__aiter__()
+            while True:
+                resumed = time.perf_counter()
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    waited += time.perf_counter() - resumed
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if first:
+                        upstream_first_chunk_seconds.observe(time.perf_counter() - start, model)
+                        first = False
+                    yield chunk.choices[0].delta.content
+        except Exception:
+            upstream_errors.inc(model)
+            raise
+        finally:
+            upstream_seconds.observe(waited, model)
+            if clock is not None:
+                clock["seconds"] += waited
+
+def split_message(text, limit=TELEGRAM_LIMIT):
+    # cuts at paragraph, line, sentence or word boundaries. chunks are sent
+    # as plain text, so a "<" is not a tag to keep whole. a code fence left
+    # open by a cut is closed and reopened in the next chunk. offsets are used
+    # so long texts are not copied per chunk
+    start = 0
+    fence = False
+    budget = limit - 8
+    while len(text) - start + (4 if fence else 0) > limit:
+        end = start + budget
+        cut = end
+        for separator in ("\n\n", "\n", ". ", " "):
+            found = text.rfind(separator, start + budget // 2, end)
+            if found != -1:
+                cut = found + len(separator)
+                break
+        chunk = text[start:cut]
+        reopened = fence
+        if chunk.count("```") % 2:
+            fence = not fence
+        yield ("```\n" if reopened else "") + chunk + ("\n```" if fence else "")
+        start = cut
+    if start < len(text):
+        yield ("```\n" if fence else "") + text[start:]
+
+async def reply_long(message: types.Message, text):
+    for chunk in split_message(text):
+        if chunk.strip():
+            await message.reply(chunk, parse_mode=None)
+
+async def stream_reply(message: types.Message, pieces):
+    # edits are coalesced to one per STREAM_EDIT_INTERVAL to stay under
+    # telegram's edit rate limit; text past TELEGRAM_LIMIT goes to a new message.
+    # telegram strips surrounding whitespace and rejects edits that change
+    # nothing, so shown holds the stripped text
+    loop = asyncio.get_running_loop()
+    parts = []
+    text = ""
+    sent = None
+    shown = ""
+    last_edit = 0.0
+    async for piece in pieces:
+        parts.append(piece)
+        text += piece
+        if len(text) > TELEGRAM_LIMIT:
+            *heads, text = split_message(text)
+            for head in heads:
+                if sent:
+                    if head.strip() != shown:
+                        await sent.edit_text(head, parse_mode=None)
+                    sent = None
+                elif head.strip():
+                    await message.reply(head, parse_mode=None)
+            shown = ""
+        if not text.strip():
+            continue
+        if sent is None:
+            sent = await message.reply(text, parse_mode=None)
+            shown = text.strip()
+            last_edit = loop.time()
+        elif loop.time() - last_edit >= STREAM_EDIT_INTERVAL and text.strip() != shown:
+            await sent.edit_text(text, parse_mode=None)
+            shown = text.strip()
+            last_edit = loop.time()
+    if sent and text.strip() != shown:
+        await sent.edit_text(text, parse_mode=None)
+    elif sent is None and text.strip():
+        await message.reply(text, parse_mode=None)
+    return "".join(parts)
+
+def export_request(text):
+    # "file:md" in a message asks for the answer as file.md
+    match = re.search(r"file:\w*", text)
+    if not match:
+        return text, None
+    return text.replace(match.group(0), ""), ".".join(match.group(0).split(":"))
+
+async def send_export(chat_id, filename, text):
+    document = types.BufferedInputFile(text.encode("utf-8"), filename=filename)
+    await bot.send_document(chat_id, document)
+
+async def replay(text):
+    yield text
+
+async def image_generation(**kwargs):
+    async with scheduler.slot("image"):
+        with upstream_timer(kwargs.get("model")):
+            return await upstream.call(
+                kwargs.get("model"), lambda client: client.images.generate(**kwargs)
+            )
+
+async def generate_images(model, prompt, n):
+    if registry.option(model, "single_image"):
+        responses = await asyncio.gather(
+            *(image_generation(model=model, prompt=prompt, n=1) for _ in range(n))
+        )
+        return [image.url for response in responses for image in response.data]
+    response = await image_generation(model=model, prompt=prompt, n=n)
+    return [image.url for image in response.data]
+
+async def send_photos(chat_id, photos):
+    # one media group instead of a message per image
+    if len(photos) == 1:
+        sent = [await bot.send_photo(chat_id, photo=photos[0])]
+    else:
+        sent = await bot.send_media_group(
+            chat_id, media=[types.InputMediaPhoto(media=photo) for photo in photos[:10]]
+        )
+    return [message.photo[-1].file_id for message in sent]
+
+class ResponseCache:
+    # maps (kind, model, normalized input, params) to telegram file_ids so
+    # repeats are re-sent without calling upstream
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+def normalize(text):
+    return " ".join(text.lower().split())
+
+response_cache = ResponseCache(CACHE_MAX_ENTRIES, CACHE_TTL)
+
+def embed(text):
+    # hashed character trigram counts, a cheap local embedding for near-duplicate questions
+    text = f" {text} "
+    vector = {}
+    for i in range(len(text) - 2):
+        gram = text[i:i + 3]
+        vector[gram] = vector.get(gram, 0) + 1
+    norm = sum(count * count for count in vector.values()) ** 0.5
+    return vector, norm
+
+class AnswerCache:
+    # exact lookups are a dict hit. similar lookups use an inverted index from
+    # trigram to entries, and only the entries sharing most trigrams are scored
+    def __init__(self, max_entries, ttl, threshold, candidates=20):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.candidates = candidates
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self._entries = OrderedDict()
+        self._index = {}
+
+    def lookup(self, model, text):
+        key = (model, normalize(text))
+        entry = self._entries.get(key)
+        if entry is None and self.threshold < 1:
+            key = self._similar(model, key[1])
+            entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        self.saved_seconds += entry[2]
+        return entry[1]
+
+    def store(self, model, text, answer, seconds):
+        key = (model, normalize(text))
+        if key in self._entries:
+            self._remove(key)
+        vector, norm = embed(key[1])
+        self._entries[key] = (time.monotonic() + self.ttl, answer, seconds, vector, norm)
+        for gram in vector:
+            self._index.setdefault((model, gram), set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _similar(self, model, text):
+        vector, norm = embed(text)
+        shared = {}
+        for gram in vector:
+            for key in self._index.get((model, gram), ()):
+                shared[key] = shared.get(key, 0) + 1
+        best, best_score = None, self.threshold
+        for key in sorted(shared, key=shared.get, reverse=True)[:self.candidates]:
+            other, other_norm = self._entries[key][3:5]
+            dot = sum(count * other.get(gram, 0) for gram, count in vector.items())
+            score = dot / (norm * other_norm) if norm and other_norm else 0
+            if score >= best_score:
+                best, best_score = key, score
+        return best
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        for gram in entry[3]:
+            keys = self._index.get((key[0], gram))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[(key[0], gram)]
+
+answer_cache = AnswerCache(CHAT_CACHE_MAX_ENTRIES, CHAT_CACHE_TTL, CHAT_CACHE_THRESHOLD)
+
+class SingleFlight:
+    # concurrent calls with the same key share one upstream future. it is
+    # shielded so one waiter giving up does not cancel it for the others,
+    # and runs outside any user's context so the scheduler never gives it
+    # one waiter's tier or drops it because that waiter finished the dialogue
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._futures = {}
+
+    async def _shared(self, fn):
+        current_user.set(None)
+        return await fn()
+
+    async def run(self, key, fn):
+        future = self._futures.get(key)
+        if future is not None:
+            self.coalesced += 1
         else:
-            msg = str() + " " + str(model) +" "+ text
-        await bot.send_message(chat_id=userlog, text=msg)
+            self.calls += 1
+            future = asyncio.ensure_future(self._shared(fn))
+            self._futures[key] = future
+            future.add_done_callback(lambda _: self._futures.pop(key, None))
+        return await asyncio.shield(future)
+
+single_flight = SingleFlight()
+
+log_queue = asyncio.Queue(LOG_QUEUE_SIZE)
+# cumulative, the digest reports what was dropped since the one before
+log_dropped = 0
+log_dropped_reported = 0
+
+async def logme(username, model, text):
+    # never waits: events are batched into digests by flush_logs
+    global log_dropped
+    if not (userlog or LOG_FILE):
+        return
+    event = {"time": time.time(), "user": str(username or ""), "model": str(model), "text": str(text or "")}
+    with timed("logme", "enqueue"):
+        try:
+            log_queue.put_nowait(event)
+        except asyncio.QueueFull:
+            log_dropped += 1
+
+def write_log_file(events):
+    with open(LOG_FILE, "a") as log_file:
+        for event in events:
+            log_file.write(json.dumps(event) + "\n")
+
+def pack_lines(lines, limit=TELEGRAM_LIMIT):
+    chunk = ""
+    for line in lines:
+        line = line[:limit]
+        if chunk and len(chunk) + 1 + len(line) > limit:
+            yield chunk
+            chunk = ""
+        chunk = chunk + "\n" + line if chunk else line
+    if chunk:
+        yield chunk
+
+async def flush_logs():
+    global log_dropped_reported
+    events = []
+    while not log_queue.empty():
+        events.append(log_queue.get_nowait())
+    dropped, log_dropped_reported = log_dropped - log_dropped_reported, log_dropped
+    if dropped:
+        logging.warning("%d user log events dropped, queue full", dropped)
+    if LOG_FILE and events:
+        await asyncio.to_thread(write_log_file, events)
+    if userlog and (events or dropped):
+        lines = [" ".join([e["user"], e["model"], e["text"]]) for e in events]
+        if dropped:
+            lines.append(f"{dropped} log events dropped, queue full")
+        for digest in pack_lines(lines):
+            await bot.send_message(chat_id=userlog, text=digest, parse_mode=None)
+
+async def log_consumer():
+    while await lifecycle.pause(LOG_FLUSH_INTERVAL):
+        try:
+            await flush_logs()
+        except Exception as e:
+            logging.exception("Error sending user log: %s", e)
+
+class HttpClients:
+    # one keep-alive pool for every non-openai upstream, created on first use
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, limit, limit_per_host, timeout, retries):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.session = None
+
+    def start(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.limit, limit_per_host=self.limit_per_host, ttl_dns_cache=300
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self.session
+
+    async def request(self, method, url, **kwargs):
+        # retries connection errors and retryable statuses with full jitter backoff
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                async with self.start().request(method, url, **kwargs) as resp:
+                    body = await resp.read()
+                    if resp.status not in self.RETRY_STATUSES or last:
+                        return resp.status, body
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if last:
+                    raise
+            await asyncio.sleep(random.uniform(0, 0.5 * 2 ** attempt))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+http_clients = HttpClients(HTTP_LIMIT, HTTP_LIMIT_PER_HOST, HTTP_TIMEOUT, HTTP_RETRIES)
 
 async def generate_speech(text: str, chat_id):
     try:
         user_id = chat_id
-        user_data = user_states.get(user_id, {})
-        model = user_data.get("model")
+        user_data = user_states.get(user_id) or Session()
+        model = user_data.model
         headers = {"Authorization": f"Bearer {openai_key}"}
         s_data = {
                 "text": text,
-                "voice_id": voice_d[model]
+                "voice_id": registry.option(model, "voice_id")
                 }
-        async with aiohttp.ClientSession(headers=headers) as session:
-            async with session.post(
-                openai_base +"/audio/tts" , json=s_data
-            ) as resp:
-                if resp.status == 200:
-                    print(resp)
-                    response = await resp.read()
-                    return json.loads(response.decode('utf-8'))
-                else:
-                    error_message = await resp.text()
-                    raise Exception(
-                        f"Text-to-speech API returned non-200 status code: {resp.status}. Error: {error_message}"
-                    )
+        async with scheduler.slot("tts"):
+            with upstream_timer(model):
+                status, response = await http_clients.request(
+                    "POST", openai_base + "/audio/tts", json=s_data, headers=headers
+                )
+        if status == 200:
+            return json.loads(response.decode('utf-8'))
+        raise Exception(
+            f"Text-to-speech API returned non-200 status code: {status}. Error: {response.decode(errors='replace')}"
+        )
+    except JobDropped:
+        raise
     except Exception as e:
         raise Exception(f"Error in generating speech: {str(e)}")
 
+def pick_photo(photos):
+    # telegram already stores downscaled copies, use the largest one that fits
+    fitting = [photo for photo in photos if max(photo.width, photo.height) <= VISION_MAX_SIDE]
+    return fitting[-1] if fitting else photos[0]
+
+async def upload_imgbb(encoded):
+    with upstream_timer("imgbb"):
+        status, response = await http_clients.request(
+            "POST",
+            "https://api.imgbb.com/1/upload",
+            data={"key": IMGBB_API_KEY, "expiration": "500", "image": encoded},
+        )
+    if status != 200:
+        raise Exception(f"imgbb returned non-200 status code: {status}. Error: {response.decode(errors='replace')}")
+    return json.loads(response)["data"]["url"]
+
+async def photo_url(photos):
+    buffer = await bot.download(pick_photo(photos))
+    encoded = base64.b64encode(buffer.getvalue()).decode()
+    if VISION_IMAGE_MODE == "imgbb":
+        return await upload_imgbb(encoded)
+    return "data:image/jpeg;base64," + encoded
+
 async def generate_vision(text: str, chat_id, im_url):
     try:
         user_id = chat_id
-        user_data = user_states.get(user_id, {})
-        model = user_data.get("model")
+        user_data = user_states.get(user_id) or Session()
+        model = user_data.model
         headers = {"Authorization": f"Bearer {openai_key}", 'Content-Type': 'application/json'}
         # json_data = {"input": text, "model": model, "language": "en"}
         
-        conversation = user_data["conversation"]
-
-        if not im_url:
-            if model == "llava-13b":
-                conversation.append({"role": "user", "content": text})
-            else:
-                conversation.append({'role': 'user', 'content': [{'type': 'text', 'text': text}]})
+        llava = registry.option(model, "format") == "llava"
+        if llava:
+            turn = [{"role": "user", "content": text}]
+            if im_url:
+                turn.insert(0, {"role": "system", "content": im_url})
         else:
-            if model == "gemini-pro-vision":
-                conversation.append(
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": text},
-                            {
-                                "type": "image_url",
-                                "image_url": im_url
-                            },
-                        ],
-                    }
-                )
-            else:
-                 conversation.append({"role": "system", "content": im_url})
-                 conversation.append({"role": "user", "content": text})
-                
-        resp = client.chat.completions.create(
+            content = [{"type": "text", "text": text}]
+            if im_url:
+                content.append({"type": "image_url", "image_url": im_url})
+            turn = [{"role": "user", "content": content}]
+        user_data.add(*(stored_message(message) for message in turn))
+        history = user_data.conversation[:-len(turn)]
+
+        resp = await chat_completion(
             model=model,
-            messages=conversation,
+            messages=history + turn,
             stream=False,
         )
         if resp:
             ai_response = resp.choices[0].message.content
-            if model == "llava-13b":
-                conversation.append({"role": "user", "content": ai_response})
+            if llava:
+                user_data.add({"role": "user", "content": ai_response})
             else:
-                conversation.append({'role': 'user', 'content': [{'type': 'text', 'text': ai_response}]})
+                user_data.add({'role': 'user', 'content': [{'type': 'text', 'text': ai_response}]})
 
             return ai_response
         else:
             return "server error"
 
+    except JobDropped:
+        raise
     except Exception as e:
         raise Exception(f"Error : {str(e)}")
 
@@ -172,37 +1712,16 @@ async def start_dialog(user_id, message, state: FSMContext):
         await message.reply("How did you find this bot? answer to continue")
         await state.set_state(Intro.waiting_for_reason)
         return
-    user_data = user_states[user_id]
+    user_data = user_states.get(user_id)
 
-    if user_data["model"]:
+    if user_data.model:
         await bot.send_message(
             user_id, "Please complete the ongoing conversation first."
         )
     else:
-        user_states[user_id] = {"model": None, "button_sent": False, "conversation": []}
-        chat_button = types.InlineKeyboardButton(
-            text="Chat", callback_data="text_nested_keyboard"
-        )
-        image_button = types.InlineKeyboardButton(
-            text="Create Image", callback_data="image_nested_keyboard"
-        )
-        tts_button = types.InlineKeyboardButton(
-            text="Text-to-Speech (BROKEN)", callback_data="audio_nested_keyboard"
-        )
-        vision_button = types.InlineKeyboardButton(
-            text="Vision", callback_data="vision_nested_keyboard"
-        )
-
-        model_buttons = []
-        model_buttons.append([chat_button])
-        model_buttons.append([image_button])
-        model_buttons.append([tts_button])
-        model_buttons.append([vision_button])
-
-        # Create keyboard
-        model_keyboard = types.InlineKeyboardMarkup(inline_keyboard=model_buttons)
+        user_states.reset(user_id)
         await message.reply(
-            f"Choose an option:", reply_markup=model_keyboard
+            f"Choose an option:", reply_markup=registry.main_keyboard
         )
 
 @dp.message(Intro.waiting_for_reason)
@@ -213,7 +1732,7 @@ async def handle_reason(message: types.Message, state: FSMContext):
     await logme(user_info , "Intro", message.text)
     await state.clear()
 
-    user_states[user_id] = {"model": None, "button_sent": False, "conversation": []}
+    user_states.reset(user_id)
     await message.answer(
         f"Hello, {user.first_name}! I'm EvilgrinGPT created by evilgrin.",
         reply_markup=get_start_dialog_keyboard(),
@@ -229,144 +1748,52 @@ async def handle_start(message: types.Message, state: FSMContext):
         await message.reply("How did you find this bot? answer to continue")
         await state.set_state(Intro.waiting_for_reason)
     else:
-        user_states[user_id] = {"model": None, "button_sent": False, "conversation": []}
-        await start_dialog()
+        user_states.reset(user_id)
+        await start_dialog(user_id, message, state)
 
 
-@dp.callback_query(
-    lambda query: query.data
-    in ("text_nested_keyboard", "image_nested_keyboard", "audio_nested_keyboard", "vision_nested_keyboard")
-)
+@dp.callback_query(lambda query: query.data in registry.menus)
 async def nested_keyboard(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
-    if callback_query.data == "text_nested_keyboard":
-        model_buttons = [
-            [types.InlineKeyboardButton(text=model, callback_data=model)]
-            for model in available_models
-        ]
-    elif callback_query.data == "image_nested_keyboard":
-        model_buttons = [
-            [types.InlineKeyboardButton(text=model, callback_data=model)]
-            for model in image_models
-        ]
-
-    elif callback_query.data == "audio_nested_keyboard":
-        model_buttons = [
-            [types.InlineKeyboardButton(text=model, callback_data=model)]
-            for model in voice_models
-        ]
-    else:
-        model_buttons = [
-            [types.InlineKeyboardButton(text=model, callback_data=model)]
-            for model in vision_models
-        ]
-
-    model_keyboard = types.InlineKeyboardMarkup(inline_keyboard=model_buttons)
     await bot.send_message(
-        user_id, f"Please select a model", reply_markup=model_keyboard
+        user_id, f"Please select a model", reply_markup=registry.keyboards[callback_query.data]
     )
 
-@dp.callback_query(
-    lambda query: query.data in available_models
-    or query.data in image_models
-    or query.data in voice_models
-    or query.data in vision_models
-)
+@dp.callback_query(lambda query: query.data in registry.models)
 async def select_model_or_image_prompt(
     callback_query: types.CallbackQuery, state: FSMContext
 ):
     user_id = callback_query.from_user.id
 
-    if user_id not in user_states:
-        user_states[user_id] = {"model": None, "button_sent": False, "conversation": []}
+    user_data = user_states.get(user_id) or user_states.reset(user_id)
+    mode = registry.mode_of(callback_query.data)
 
     await callback_query.answer()
-    if callback_query.data in image_models:
-        await callback_query.message.answer("Enter text for the prompt:")
-        await state.set_state(ImagePrompt.waiting_for_text)
-        selected_model = callback_query.data
-        user_states[user_id]["model"] = selected_model
-        await callback_query.message.edit_text(
-            f"Selected Model: {selected_model}.\nSend a message to start the dialogue."
-        )
-
-        cancel_button = KeyboardButton(text="Finish Dialogue")
-        cancel_markup = ReplyKeyboardMarkup(
-            keyboard=[[cancel_button]], resize_keyboard=True
-        )
-        await callback_query.message.answer(
-            'You can finish the dialogue by pressing the "Finish Dialogue" button.',
-            reply_markup=cancel_markup,
-        )
-        user_states[user_id]["button_sent"] = True
-    
-    elif callback_query.data in vision_models:
-        await callback_query.message.answer(
-            "Upload a photo with your question as the caption "
-        )
-        await state.set_state(Viz.waiting_for_vision)
-        selected_model = callback_query.data
-        user_states[user_id]["model"] = selected_model
-        await callback_query.message.edit_text(
-            f"Selected Model: {selected_model}.\nSend a message to start the dialogue."
-        )
-
-        cancel_button = KeyboardButton(text="Finish Dialogue")
-        cancel_markup = ReplyKeyboardMarkup(
-            keyboard=[[cancel_button]], resize_keyboard=True
-        )
-        await callback_query.message.answer(
-            'You can finish the dialogue by pressing the "Finish Dialogue" button.',
-            reply_markup=cancel_markup,
-        )
-        user_states[user_id]["button_sent"] = True
-
-    elif callback_query.data in voice_models:
-        await callback_query.message.answer(
-            "Limit is 50 characters. Enter the text for speech synthesis:"
-        )
-        await state.set_state(Tts.waiting_for_tts)
-        selected_model = callback_query.data
-        user_states[user_id]["model"] = selected_model
-        await callback_query.message.edit_text(
-            f"Selected Model: {selected_model}.\nSend a message to start the dialogue."
-        )
-
-        cancel_button = KeyboardButton(text="Finish Dialogue")
-        cancel_markup = ReplyKeyboardMarkup(
-            keyboard=[[cancel_button]], resize_keyboard=True
-        )
-        await callback_query.message.answer(
-            'You can finish the dialogue by pressing the "Finish Dialogue" button.',
-            reply_markup=cancel_markup,
-        )
-        user_states[user_id]["button_sent"] = True
-    else:
-        selected_model = callback_query.data
-        user_states[user_id]["model"] = selected_model
-        await callback_query.message.edit_text(
-            f"Selected Model: {selected_model}.\nSend a message to start the dialogue."
-        )
-        cancel_button = KeyboardButton(text="Finish Dialogue")
-        cancel_markup = ReplyKeyboardMarkup(
-            keyboard=[[cancel_button]], resize_keyboard=True
-        )
-        await callback_query.message.answer(
-            'You can finish the dialogue by pressing the "Finish Dialogue" button.',
-            reply_markup=cancel_markup,
-        )
-        user_states[user_id]["button_sent"] = True
+    if mode.prompt:
+        await callback_query.message.answer(mode.prompt)
+    if mode.state:
+        await state.set_state(mode.state)
+    selected_model = callback_query.data
+    user_data.model = selected_model
+    await callback_query.message.edit_text(
+        f"Selected Model: {selected_model}.\nSend a message to start the dialogue."
+    )
+    await callback_query.message.answer(
+        'You can finish the dialogue by pressing the "Finish Dialogue" button.',
+        reply_markup=finish_dialog_markup,
+    )
+    user_data.button_sent = True
 
 @dp.message(ImagePrompt.waiting_for_text)
 async def process_text(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    user_data = user_states.get(user_id, {})
-    model = user_data.get("model")
+    user_data = user_states.get(user_id) or Session()
+    model = user_data.model
     user_info = " ".join([message.from_user.full_name, message.from_user.username, str(message.from_user.id)])
     await logme(user_info , model, message.text)
     if message.text.lower() == "finish dialogue":
         await state.clear()
-        user_states[user_id] = {"model": None, "button_sent": False, "conversation": []}
+        user_states.reset(user_id)
         await message.reply(
             'Dialogue finished. You can start a new dialogue by clicking "Start Dialogue".',
             reply_markup=get_start_dialog_keyboard(),
@@ -374,9 +1801,23 @@ async def process_text(message: types.Message, state: FSMContext):
         return
     try:
         prompt_text = message.text
-        response = client.images.generate(model=model, prompt=prompt_text, n=2)
-        for img_url in response.data:
-            await bot.send_photo(message.chat.id, photo=img_url.url)
+        n = IMAGE_N
+        count = re.search(r"\bn:(\d+)", prompt_text)
+        if count:
+            prompt_text = (prompt_text[:count.start()] + prompt_text[count.end():]).strip()
+            n = int(count.group(1))
+        n = max(1, min(n, IMAGE_MAX_N))
+        key = ("image", model, normalize(prompt_text), n)
+        file_ids = response_cache.get(key)
+        if file_ids:
+            with timed("process_text", "send"):
+                await send_photos(message.chat.id, file_ids)
+            return
+        with timed("process_text", "generate"):
+            urls = await single_flight.run(key, lambda: generate_images(model, prompt_text, n))
+        with timed("process_text", "send"):
+            file_ids = await send_photos(message.chat.id, urls)
+        response_cache.put(key, file_ids)
 
     except openai.APIError as e:
         error_message = "An error occurred while creating the image: "
@@ -390,8 +1831,8 @@ async def process_text(message: types.Message, state: FSMContext):
 async def cancel(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     user_data = user_states.get(user_id)
-    if user_data and user_data.get("button_sent"):
-        user_states[user_id] = {"model": None, "button_sent": False, "conversation": []}
+    if user_data and user_data.button_sent:
+        user_states.reset(user_id)
         await state.clear()
         await message.answer(
             'Dialogue finished. You can start a new dialogue by clicking "Start Dialogue".',
@@ -405,16 +1846,15 @@ async def process_tts_text(message: types.Message, state: FSMContext):
     try:
         text = message.text
         user_id = message.chat.id
-        user_data = user_states.get(user_id, {})
-        model = user_data.get("model")
+        user_data = user_states.get(user_id) or Session()
+        model = user_data.model
         user_info = " ".join([message.from_user.full_name, message.from_user.username, str(message.from_user.id)])
         await logme(user_info , model, message.text)
 
         if text.lower() == "finish dialogue":
             await state.clear()
             user_id = message.from_user.id
-            user_states[user_id]["model"] = None
-            user_states[user_id]["button_sent"] = False
+            user_states.reset(user_id)
             await message.reply(
                 'Dialogue finished. You can start a new dialogue by clicking "Start Dialogue".',
                 reply_markup=get_start_dialog_keyboard(),
@@ -426,10 +1866,13 @@ async def process_tts_text(message: types.Message, state: FSMContext):
         if not text:
             text = "Please enter valid text."
 
-        await generate_tts_for_text(text, message.chat.id)
+        with timed("process_tts_text", "synthesize"):
+            await generate_tts_for_text(text, message.chat.id)
 
+    except JobDropped:
+        raise
     except Exception as error:
-        print("An exception occurred:", error)
+        logging.exception("Error in text-to-speech for %s: %s", message.chat.id, error)
         await message.reply("Error in text-to-speech synthesis.")
 
 @dp.message(Viz.waiting_for_vision)
@@ -441,16 +1884,16 @@ async def process_vision(message: types.Message, state: FSMContext):
             if message.caption:
                 text = message.caption
             else:
-                message.reply("Enter valid caption")
+                await message.reply("Enter valid caption")
                 return
         user_id = message.chat.id
-        user_data = user_states.get(user_id, {})
-        model = user_data.get("model")
+        user_data = user_states.get(user_id) or Session()
+        model = user_data.model
         
         if text.lower() == "finish dialogue":
             await state.clear()
             user_id = message.from_user.id
-            user_states[user_id] = {"model": None, "button_sent": False, "conversation": []}
+            user_states.reset(user_id)
             await message.reply(
                 'Dialogue finished. You can start a new dialogue by clicking "Start Dialogue".',
                 reply_markup=get_start_dialog_keyboard(),
@@ -458,60 +1901,79 @@ async def process_vision(message: types.Message, state: FSMContext):
             return
         
         if message.caption:
-            res = await bot.download(message.photo[-1],  destination="/tmp/teleimg.jpg")
-
-            client = imgbbpy.AsyncClient(IMGBB_API_KEY)
-            img = await client.upload(file='/tmp/teleimg.jpg', expiration=500)
-            await client.close()
-            img_url = img.url
+            with timed("process_vision", "image"):
+                img_url = await photo_url(message.photo)
         
             user_info = " ".join([message.from_user.full_name, message.from_user.username, str(message.from_user.id)])
             await logme(user_info , model, message.text)
         else:
             img_url = None
 
-        tmp_file_name = ""
-        if re.search("file:\w*", text):
-            tmp_file_name = re.search("file:\w*", text).group(0)
-            text = text.replace(tmp_file_name, "")
-            tmp_file_name = tmp_file_name.split(":")
-            tmp_file_name = ".".join(tmp_file_name)
+        text, export_name = export_request(text)
         
-        resp = await generate_vision(text, message.chat.id, img_url)
-        if tmp_file_name:
-            with open("/tmp/"+tmp_file_name, "w") as docu:
-                docu.write(resp)
-            tmpf = FSInputFile("/tmp/"+tmp_file_name)
-            await bot.send_document(message.chat.id, tmpf)
-            os.remove("/tmp/"+tmp_file_name)
-        await message.reply(resp)
+        with timed("process_vision", "completion"):
+            resp = await generate_vision(text, message.chat.id, img_url)
+        if export_name:
+            await send_export(message.chat.id, export_name, resp)
+        with timed("process_vision", "reply"):
+            await reply_long(message, resp)
 
+    except JobDropped:
+        raise
     except Exception as error:
-        print("An exception occurred:", error)
+        logging.exception("Error in vision for %s: %s", message.chat.id, error)
         await message.reply("Error in vision")
 
 async def generate_tts_for_text(text: str, chat_id: int):
     if text:
-        resp = await generate_speech(text, chat_id)
+        model = (user_states.get(chat_id) or Session()).model
+        key = ("tts", model, normalize(text))
+        file_id = response_cache.get(key)
+        if file_id:
+            await bot.send_audio(chat_id, audio=file_id, title=text[:5], performer="evilgrin")
+            return
+        resp = await single_flight.run(key, lambda: generate_speech(text, chat_id))
         url = resp["url"]
-        await bot.send_audio(chat_id, audio=url, title=text[:5], performer="evilgrin")
+        sent = await bot.send_audio(chat_id, audio=url, title=text[:5], performer="evilgrin")
+        response_cache.put(key, sent.audio.file_id)
 
 @dp.message(F.content_type.in_({"text"}))
 async def chat_message(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    user_data = user_states.get(user_id, {})
-    model = user_data.get('model')
+    user_data = user_states.get(user_id) or Session()
+    model = user_data.model
     user_info = " ".join([message.from_user.full_name, message.from_user.username, str(message.from_user.id)])
     await logme(user_info , model, message.text)
     if model:
-        conversation = user_data["conversation"]
-        conversation.append({"role": "user", "content": message.text})
+        first_turn = not user_data.conversation
+        text, export_name = export_request(message.text)
+        user_data.add({"role": "user", "content": text})
         try:
-            response = client.chat.completions.create(model=model, messages=conversation)
-            conversation.append(response.choices[0].message)
-            ai_response = response.choices[0].message.content
-            await message.reply(ai_response)
+            cached = answer_cache.lookup(model, text) if CHAT_CACHE and first_turn else None
+            # upstream time only, what a later cache hit saves
+            clock = {"seconds": 0.0}
+            if cached is not None:
+                with timed("chat_message", "reply"):
+                    ai_response = await stream_reply(message, replay(cached))
+            elif STREAM_REPLIES:
+                with timed("chat_message", "completion"):
+                    ai_response = await stream_reply(
+                        message, chat_stream(clock, model=model, messages=user_data.conversation)
+                    )
+            else:
+                with timed("chat_message", "completion"):
+                    response = await chat_completion(clock, model=model, messages=user_data.conversation)
+                ai_response = response.choices[0].message.content
+                with timed("chat_message", "reply"):
+                    await reply_long(message, ai_response)
+            if CHAT_CACHE and first_turn and cached is None:
+                answer_cache.store(model, text, ai_response, clock["seconds"])
+            user_data.add({"role": "assistant", "content": ai_response})
+            if export_name:
+                await send_export(message.chat.id, export_name, ai_response)
 
+        except JobDropped:
+            raise
         except Exception as e:
             error_message = "An error occurred text: "
             if hasattr(e, "response") and "detail" in e.response:
@@ -520,16 +1982,12 @@ async def chat_message(message: types.Message, state: FSMContext):
                 error_message += str(e)
             await message.answer(error_message)
 
-        if not user_data.get("button_sent", False):
-            cancel_button = KeyboardButton(text="Finish Dialogue")
-            cancel_markup = ReplyKeyboardMarkup(
-                keyboard=[[cancel_button]], resize_keyboard=True
-            )
+        if not user_data.button_sent:
             await message.answer(
                 'You can finish the dialogue by pressing the "Finish Dialogue" button.',
-                reply_markup=cancel_markup,
+                reply_markup=finish_dialog_markup,
             )
-            user_states[user_id]["button_sent"] = True
+            user_data.button_sent = True
     else:
         await start_dialog(user_id, message, state)
 
@@ -538,8 +1996,113 @@ def get_start_dialog_keyboard():
     start_markup = ReplyKeyboardMarkup(keyboard=[[start_button]], resize_keyboard=True)
     return start_markup
 
+class UserOrderedPool:
+    # updates from one user are handled strictly in order, updates from
+    # different users run concurrently up to the worker limit
+    def __init__(self, workers):
+        self.limit = asyncio.Semaphore(workers)
+        self._queues = {}
+        self.tasks = set()
+
+    def submit(self, key, update):
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(update)
+            return
+        self._queues[key] = deque([update])
+        task = asyncio.create_task(self._drain(key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _drain(self, key):
+        queue = self._queues[key]
+        try:
+            while queue:
+                async with self.limit:
+                    try:
+                        await dp.feed_update(bot, queue[0])
+                    except Exception as e:
+                        logging.exception("Error handling update: %s", e)
+                queue.popleft()
+        finally:
+            del self._queues[key]
+
+def update_user_id(update: types.Update):
+    user = getattr(update.event, "from_user", None)
+    return user.id if user else update.update_id
+
+async def run_webhook():
+    pool = UserOrderedPool(WEBHOOK_WORKERS)
+
+    async def receive(request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        update = types.Update.model_validate(await request.json(), context={"bot": bot})
+        try:
+            key = update_user_id(update)
+        except UpdateTypeLookupError:
+            # a type this aiogram does not know, an error would only make telegram redeliver it
+            logging.warning("Ignoring update %s of an unknown type", update.update_id)
+            return web.Response()
+        pool.submit(key, update)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, receive)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    try:
+        await lifecycle.stopping.wait()
+    finally:
+        await runner.cleanup()
+        await lifecycle.drain(pool.tasks)
+
 async def main() -> None:
-    await dp.start_polling(bot, skip_updates=True)
+    flusher = asyncio.create_task(write_behind())
+    log_task = asyncio.create_task(log_consumer())
+    lag_task = asyncio.create_task(measure_loop_lag())
+    models_task = asyncio.create_task(watch_models()) if MODELS_FILE else None
+    metrics_runner = await start_metrics_server() if METRICS_PORT else None
+    lifecycle.started()
+    try:
+        if BOT_MODE == "webhook":
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(sig, lifecycle.stopping.set)
+            await run_webhook()
+        else:
+            # aiogram stops polling on SIGTERM/SIGINT, handlers still running are drained below
+            await dp.start_polling(bot, skip_updates=True, close_bot_session=False)
+            await lifecycle.drain()
+    finally:
+        # the flush loops finish the round they are in, so no batch is cut off
+        lifecycle.closing.set()
+        background = [flusher, log_task, lag_task] + ([models_task] if models_task else [])
+        lag_task.cancel()
+        if models_task is not None:
+            models_task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await flush_state()
+        await flush_logs()
+        await fsm_storage.close()
+        if session_backend is not None:
+            await session_backend.close()
+        if openai_http is not None:
+            await openai_http.aclose()
+        await http_clients.close()
+        await bot.session.close()
+        logging.info(
+            "Stopped: %d handlers drained, %d cancelled", lifecycle.drained, lifecycle.cancelled
+        )
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
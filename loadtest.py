@@ -0,0 +1,772 @@
+import argparse
+import base64
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import socket
+import ssl
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from contextlib import asynccontextmanager
+
+from aiohttp import web
+
+# drives the real dispatcher in bot.py against a fake telegram bot api and a
+# fake openai compatible server, both local, so it runs offline.
+#
+#   python3 loadtest.py --users 2000 --flows chat,image,tts,vision --output results.json
+#   python3 loadtest.py --mode scaling --concurrency 64
+#   python3 loadtest.py --mode memory --users 100000
+#   python3 loadtest.py --mode long --messages 500 --tokens 200 --latency 0 --token-delay 0
+#   python3 loadtest.py --mode webhook --users 500 --latency 0 --token-delay 0 --no-stream
+#   python3 loadtest.py --mode http --users 500 --concurrency 10 --latency 0.01
+#   python3 loadtest.py --mode ttft --users 16 --concurrency 16 --tokens 200 --token-delay 0.02
+#   python3 loadtest.py --endpoints 0.2:0.5,0.2:0:0.1 --retries 2
+#
+# every user sends its own prompts so the image and tts caches only help
+# with --shared-prompts. the bot's upstream retries default to 0 here so
+# injected faults show up as errors, pass --retries to measure them
+
+TOKEN = "123456:LOADTEST"
+ERROR_PREFIXES = ("An error occurred", "Error in", "Too many requests")
+FLOW_MODELS = {"chat": "gpt-4", "image": "sdxl", "tts": "adam", "vision": "gemini-pro-vision"}
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+class Recorder:
+    # remembers when the first reply reached each chat after it was armed,
+    # and the current text of every message like telegram does
+    def __init__(self):
+        self.armed = {}
+        self.first = {}
+        self.errors = set()
+        self.texts = {}
+        self.documents = {}
+        self.sent = 0
+        self.updates = []
+        self.new_updates = asyncio.Event()
+        self.webhook = None
+
+    def queue(self, updates):
+        self.updates.extend(updates)
+        self.new_updates.set()
+
+    def arm(self, chat_id):
+        self.armed[chat_id] = time.perf_counter()
+        self.first.pop(chat_id, None)
+        self.errors.discard(chat_id)
+
+    def hit(self, chat_id, text):
+        self.sent += 1
+        if chat_id in self.armed and chat_id not in self.first:
+            self.first[chat_id] = time.perf_counter()
+            if text and text.startswith(ERROR_PREFIXES):
+                self.errors.add(chat_id)
+
+def fake_telegram(recorder):
+    message_ids = itertools.count(1)
+
+    def message(chat_id, **extra):
+        return {
+            "message_id": next(message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            **extra,
+        }
+
+    def error(description):
+        return web.json_response(
+            {"ok": False, "error_code": 400, "description": f"Bad Request: {description}"}, status=400
+        )
+
+    def photo(file_id):
+        return [{"file_id": file_id, "file_unique_id": file_id, "width": 512, "height": 512}]
+
+    async def form(request):
+        # like request.post(), but keeps uploads that aiogram sends without a content type
+        if not request.content_type.startswith("multipart/"):
+            return dict(await request.post())
+        data = {}
+        async for part in await request.multipart():
+            body = await part.read()
+            data[part.name] = (part.filename, body) if part.filename else body.decode()
+        return data
+
+    async def method(request):
+        name = request.match_info["method"]
+        data = await form(request)
+        chat_id = int(data.get("chat_id") or 0)
+        text = data.get("text")
+        if name in ("sendMessage", "editMessageText") and not (text or "").strip():
+            return error("message text is empty")
+        if name == "editMessageText":
+            key = (chat_id, int(data["message_id"]))
+            if recorder.texts.get(key) == text.strip():
+                return error("message is not modified")
+            recorder.texts[key] = text.strip()
+            result = message(chat_id, text=text)
+            result["message_id"] = key[1]
+        elif name == "sendMessage":
+            result = message(chat_id, text=text)
+            recorder.texts[(chat_id, result["message_id"])] = text.strip()
+        elif name == "sendPhoto":
+            result = message(chat_id, photo=photo(f"photo{random.random()}"))
+        elif name == "sendMediaGroup":
+            media = json.loads(data["media"])
+            result = [message(chat_id, photo=photo(f"photo{random.random()}")) for _ in media]
+        elif name == "sendAudio":
+            result = message(chat_id, audio={"file_id": "audio", "file_unique_id": "audio", "duration": 1})
+        elif name == "sendDocument":
+            # uploads are sent as attach://<field>
+            upload = data[data["document"].split("attach://", 1)[-1]]
+            recorder.documents.setdefault(chat_id, []).append(upload)
+            result = message(chat_id, document={"file_id": "doc", "file_unique_id": "doc"})
+        elif name == "getMe":
+            result = {"id": int(TOKEN.split(":")[0]), "is_bot": True, "first_name": "loadtest", "username": "loadtest_bot"}
+        elif name == "getUpdates":
+            result = await get_updates(data)
+        elif name == "setWebhook":
+            recorder.webhook = data
+            result = True
+        elif name == "getFile":
+            result = {"file_id": data["file_id"], "file_unique_id": "file", "file_path": f"photos/{data['file_id']}.jpg"}
+        else:
+            result = True
+        if chat_id and name != "editMessageText":
+            recorder.hit(chat_id, text)
+        return web.json_response({"ok": True, "result": result})
+
+    async def get_updates(data):
+        # long polling over the updates queued by the driver
+        offset = int(data.get("offset") or 0)
+        recorder.updates = [u for u in recorder.updates if u["update_id"] >= offset]
+        if not recorder.updates:
+            recorder.new_updates.clear()
+            try:
+                await asyncio.wait_for(recorder.new_updates.wait(), min(float(data.get("timeout") or 0), 0.5))
+            except asyncio.TimeoutError:
+                pass
+        return recorder.updates[:int(data.get("limit") or 100)]
+
+    async def download(request):
+        # the path is embedded so the fake vision model can say which photo it got
+        path = request.match_info["path"].encode()
+        return web.Response(body=b"\xff\xd8\xff" + path + b"\0" + os.urandom(20000))
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", method)
+    app.router.add_get("/file/bot{token}/{path:.*}", download)
+    return app
+
+def inline_photo(messages):
+    # the path of the newest inline photo in a request, as served by download
+    for message in reversed(messages):
+        content = message["content"]
+        parts = [content] if isinstance(content, str) else [
+            part["image_url"] for part in content if part.get("type") == "image_url"
+        ]
+        for url in parts:
+            if isinstance(url, str) and url.startswith("data:"):
+                data = base64.b64decode(url.split(",", 1)[1])
+                return data[3:data.index(b"\0")].decode()
+    return None
+
+def fake_openai(args, stats, served=None, seen=None):
+    # a request body seen before is a retry, prompts are unique per user.
+    # with several servers, served counts this one's share and seen is shared
+    seen = set() if seen is None else seen
+    counters = [stats] if served is None else [stats, served]
+
+    async def delay():
+        latency = args.latency * (10 if random.random() < args.slow_rate else 1)
+        await asyncio.sleep(random.uniform(latency * 0.5, latency * 1.5))
+
+    def count(body):
+        encoded = json.dumps(body, sort_keys=True)
+        key = hash(encoded)
+        for counter in counters:
+            counter["requests"] += 1
+            counter["bytes"] += len(encoded)
+            if key in seen:
+                counter["retries"] += 1
+        seen.add(key)
+
+    def failed():
+        if random.random() < args.error_rate:
+            for counter in counters:
+                counter["faults"] += 1
+            return True
+        return False
+
+    async def chat(request):
+        body = await request.json()
+        count(body)
+        await delay()
+        if failed():
+            return web.json_response({"error": {"message": "injected fault"}}, status=500)
+        words = [f"word{i} " for i in range(args.tokens)]
+        photo = inline_photo(body["messages"])
+        last = body["messages"][-1]["content"]
+        if photo:
+            words.insert(0, f"I see {photo}. ")
+        elif isinstance(last, str):
+            words.insert(0, f"You said: {last}. ")
+        if not body.get("stream"):
+            # the whole answer still takes as long to generate
+            await asyncio.sleep(args.token_delay * args.tokens)
+            return web.json_response({
+                "id": "chat",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(words)},
+                    "finish_reason": "stop",
+                }],
+            })
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        for word in words:
+            chunk = {
+                "id": "chat",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}],
+            }
+            await resp.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(args.token_delay)
+        await resp.write(b"data: [DONE]\n\n")
+        return resp
+
+    async def images(request):
+        body = await request.json()
+        count(body)
+        await delay()
+        if failed():
+            return web.json_response({"error": {"message": "injected fault"}}, status=500)
+        data = [{"url": f"https://example.com/{random.random()}.png"} for _ in range(body.get("n", 1))]
+        return web.json_response({"created": int(time.time()), "data": data})
+
+    async def tts(request):
+        count(await request.json())
+        await delay()
+        if failed():
+            return web.Response(status=500, text="injected fault")
+        return web.json_response({"url": f"https://example.com/{random.random()}.mp3"})
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat)
+    app.router.add_post("/v1/images/generations", images)
+    app.router.add_post("/v1/audio/tts", tts)
+    return app
+
+async def serve(app):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, runner.addresses[0][1]
+
+class Driver:
+    def __init__(self, app, recorder, upstream, shared_prompts=False, servers=()):
+        self.app = app
+        self.recorder = recorder
+        self.upstream = upstream
+        self.servers = list(servers)
+        self.shared_prompts = shared_prompts
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+
+    def user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": "load", "username": f"user{user_id}"}
+
+    def message(self, user_id, **content):
+        return {
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": self.user(user_id),
+                **content,
+            },
+        }
+
+    def callback(self, user_id, data):
+        return {
+            "update_id": next(self.update_ids),
+            "callback_query": {
+                "id": str(next(self.message_ids)),
+                "from": self.user(user_id),
+                "chat_instance": "load",
+                "data": data,
+                "message": {
+                    "message_id": next(self.message_ids),
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "text": "Please select a model",
+                },
+            },
+        }
+
+    async def feed(self, raw):
+        update = self.app.types.Update.model_validate(raw, context={"bot": self.app.bot})
+        await self.app.dp.feed_update(self.app.bot, update)
+
+    def request(self, user_id, flow, i):
+        tag = f"{i}" if self.shared_prompts else f"{i} from user {user_id}"
+        if flow == "vision":
+            file_id = "photo" if self.shared_prompts else f"photo{user_id}"
+            photo = [{"file_id": file_id, "file_unique_id": file_id, "width": 512, "height": 512}]
+            return self.message(user_id, photo=photo, caption=f"what is in picture {tag}")
+        if flow == "image":
+            return self.message(user_id, text=f"a cat number {tag} n:2")
+        return self.message(user_id, text=f"message number {tag}")
+
+    async def prepare(self, user_id, flow):
+        await self.feed(self.message(user_id, text="/start", entities=[{"type": "bot_command", "offset": 0, "length": 6}]))
+        await self.feed(self.message(user_id, text="load test"))
+        await self.feed(self.callback(user_id, FLOW_MODELS[flow]))
+
+    async def run_user(self, user_id, flow, messages, results):
+        await self.prepare(user_id, flow)
+        for i in range(messages):
+            self.recorder.arm(user_id)
+            start = self.recorder.armed[user_id]
+            try:
+                await self.feed(self.request(user_id, flow, i))
+            except Exception:
+                results[flow]["errors"] += 1
+                continue
+            done = time.perf_counter()
+            first = self.recorder.first.get(user_id)
+            if first is None or user_id in self.recorder.errors:
+                results[flow]["errors"] += 1
+                continue
+            results[flow]["reply"].append(first - start)
+            results[flow]["complete"].append(done - start)
+
+def load_bot():
+    os.environ.update({"TOKEN": TOKEN, "OPENAI_KEY": "loadtest", "SESSION_BACKEND": "memory"})
+    for name in ("USERLOG", "IMGBB_API_KEY", "LOG_FILE", "OPENAI_ENDPOINTS", "MODELS_FILE"):
+        os.environ.pop(name, None)
+    import bot
+
+    return bot
+
+def reset(app):
+    # the bot module is imported once, clear what earlier runs left behind
+    app.user_states._sessions.clear()
+    app.user_states._dirty.clear()
+    app.user_states._evicted.clear()
+    app.fsm_storage.storage.clear()
+    app.rate_limiter._buckets.clear()
+    app.response_cache._entries.clear()
+    app.answer_cache._entries.clear()
+    app.answer_cache._index.clear()
+    app.lifecycle.stopping = asyncio.Event()
+    app.upstream.hedges = 0
+    app.upstream._hedge_budget = 1.0
+
+@asynccontextmanager
+async def stack(args):
+    # fake telegram and openai servers with bot.py pointed at them
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    recorder = Recorder()
+    upstream = {"requests": 0, "retries": 0, "faults": 0, "bytes": 0}
+    telegram_runner, telegram_port = await serve(fake_telegram(recorder))
+    app = load_bot()
+    reset(app)
+    endpoints = app.upstream.endpoints
+    servers, runners, seen = [], [], set()
+    for spec in endpoint_specs(args):
+        served = {"requests": 0, "retries": 0, "faults": 0, "bytes": 0}
+        runner, port = await serve(fake_openai(argparse.Namespace(**{**vars(args), **spec}), upstream, served, seen))
+        servers.append({**spec, "base": f"http://127.0.0.1:{port}/v1", "served": served})
+        runners.append(runner)
+    if args.endpoints:
+        app.upstream.endpoints = [app.Endpoint(server["base"]) for server in servers]
+    else:
+        for endpoint in endpoints:
+            endpoint.base = servers[0]["base"]
+    app.openai_base = servers[0]["base"]
+    app.upstream.retries = args.retries
+    app.upstream.hedge = args.hedge
+    app.http_clients.retries = args.retries
+    app.STREAM_REPLIES = args.stream
+    app.VISION_IMAGE_MODE = "inline"
+    app.SESSION_MAX_USERS = app.user_states.max_users = max(args.users, 1)
+    app.bot.session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{telegram_port}"))
+    if args.rate_limit:
+        app.rate_limiter.rates = dict(app.family_rates)
+        app.rate_limiter.slots = {family: asyncio.Semaphore(n) for family, n in app.family_ceilings.items()}
+    else:
+        app.rate_limiter.rates = {family: (1e9, 1e9) for family in app.family_rates}
+        app.rate_limiter.slots = {family: asyncio.Semaphore(10 ** 6) for family in app.family_ceilings}
+    try:
+        yield Driver(app, recorder, upstream, args.shared_prompts, servers)
+    finally:
+        app.upstream.endpoints = endpoints
+        await app.bot.session.close()
+        await app.http_clients.close()
+        app.http_clients.session = None
+        if app.openai_http is not None:
+            await app.openai_http.aclose()
+            app.openai_http = None
+        for endpoint in app.endpoints:
+            endpoint._client = None
+        await telegram_runner.cleanup()
+        for runner in runners:
+            await runner.cleanup()
+
+def endpoint_specs(args):
+    # one fake openai server per LATENCY:ERROR_RATE[:SLOW_RATE] in --endpoints
+    if not args.endpoints:
+        return [{"latency": args.latency, "error_rate": args.error_rate, "slow_rate": args.slow_rate}]
+    specs = []
+    for item in args.endpoints.split(","):
+        latency, error_rate, slow_rate = (item.split(":") + ["0", "0"])[:3]
+        specs.append({"latency": float(latency), "error_rate": float(error_rate), "slow_rate": float(slow_rate)})
+    return specs
+
+def flow_report(result, elapsed):
+    replies = result["reply"]
+    return {
+        "requests": len(replies) + result["errors"],
+        "errors": result["errors"],
+        "throughput_rps": len(replies) / elapsed if elapsed else None,
+        "reply_p50": percentile(replies, 0.50),
+        "reply_p95": percentile(replies, 0.95),
+        "reply_p99": percentile(replies, 0.99),
+        "complete_p50": percentile(result["complete"], 0.50),
+        "complete_p95": percentile(result["complete"], 0.95),
+        "complete_p99": percentile(result["complete"], 0.99),
+    }
+
+async def run_flows(driver, args, flows):
+    results = {flow: {"reply": [], "complete": [], "errors": 0} for flow in flows}
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def user(user_id):
+        async with limit:
+            await driver.run_user(user_id, flows[user_id % len(flows)], args.messages, results)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(user(user_id) for user_id in range(1, args.users + 1)))
+    elapsed = time.perf_counter() - start
+    return elapsed, {flow: flow_report(result, elapsed) for flow, result in results.items()}
+
+async def flows_mode(args):
+    async with stack(args) as driver:
+        elapsed, flows = await run_flows(driver, args, args.flows.split(","))
+        app = driver.app
+        return {
+            "elapsed_seconds": elapsed,
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "sessions": len(app.user_states),
+            "upstream": dict(driver.upstream),
+            "endpoints": [
+                {
+                    **server["served"],
+                    "latency": endpoint.latency,
+                    "error_rate": endpoint.error_rate,
+                }
+                for server, endpoint in zip(driver.servers, app.upstream.endpoints)
+            ],
+            "hedges": app.upstream.hedges,
+            "cache_hits": app.response_cache.hits,
+            "coalesced": app.single_flight.coalesced,
+            "flows": flows,
+        }
+
+async def scaling_mode(args):
+    # the same chat workload at doubling concurrency. throughput should grow
+    # with concurrency up to OPENAI_CONCURRENCY instead of staying flat
+    levels = []
+    concurrency = 1
+    while concurrency <= args.concurrency:
+        level_args = argparse.Namespace(**{**vars(args), "users": concurrency, "concurrency": concurrency})
+        async with stack(level_args) as driver:
+            elapsed, flows = await run_flows(driver, level_args, ["chat"])
+        levels.append({"concurrency": concurrency, "elapsed_seconds": elapsed, **flows["chat"]})
+        concurrency *= 2
+    base = levels[0]["throughput_rps"]
+    for level in levels:
+        level["speedup"] = level["throughput_rps"] / base if base else None
+    return {"openai_concurrency": load_bot().OPENAI_CONCURRENCY, "levels": levels}
+
+async def ttft_mode(args):
+    # time until the first text of a chat answer is visible, streamed and not
+    report = {}
+    for stream in (True, False):
+        run_args = argparse.Namespace(**{**vars(args), "stream": stream})
+        async with stack(run_args) as driver:
+            elapsed, flows = await run_flows(driver, run_args, ["chat"])
+        report["streamed" if stream else "buffered"] = flows["chat"]
+    return report
+
+async def long_mode(args):
+    # one user chatting for --messages turns. the history is trimmed to the
+    # model's context, so latency and request size should level off
+    async with stack(args) as driver:
+        await driver.prepare(1, "chat")
+        session = driver.app.user_states.get(1)
+        every = max(1, args.messages // 20)
+        turns = []
+        for turn in range(1, args.messages + 1):
+            sent = driver.upstream["bytes"]
+            start = time.perf_counter()
+            await driver.feed(driver.request(1, "chat", turn))
+            seconds = time.perf_counter() - start
+            if turn % every == 0 or turn == 1:
+                turns.append({
+                    "turn": turn,
+                    "seconds": seconds,
+                    "payload_bytes": driver.upstream["bytes"] - sent,
+                    "history_messages": len(session.conversation),
+                    "history_tokens": session.token_total,
+                })
+        return {"context_budget": driver.app.context_budget(session.model), "turns": turns}
+
+async def memory_mode(args):
+    # pushes --users simulated users through a session store capped at
+    # --max-sessions and samples traced memory, which should level off
+    app = load_bot()
+    store = app.SessionStore(args.max_sessions, app.SESSION_TTL)
+    answer = " ".join(f"word{i}" for i in range(args.tokens))
+    step = max(1, args.users // 10)
+    samples = []
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    for user_id in range(1, args.users + 1):
+        session = store.reset(user_id)
+        session.model = "gpt-4"
+        for i in range(args.messages):
+            session.add(
+                {"role": "user", "content": f"message number {i} from user {user_id}"},
+                {"role": "assistant", "content": answer},
+            )
+        if user_id % step == 0:
+            used = tracemalloc.get_traced_memory()[0] - base
+            samples.append({"users": user_id, "sessions": len(store), "traced_bytes": used})
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return {
+        "samples": samples,
+        "peak_bytes": peak,
+        "bytes_per_session": samples[-1]["traced_bytes"] / len(store) if samples else None,
+    }
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def wait_for_replies(recorder, target):
+    while recorder.sent < target:
+        await asyncio.sleep(0.005)
+
+async def deliver_polling(driver, updates, target):
+    app = driver.app
+    polling = asyncio.create_task(
+        app.dp.start_polling(app.bot, polling_timeout=1, handle_signals=False, close_bot_session=False)
+    )
+    driver.recorder.queue(updates)
+    await wait_for_replies(driver.recorder, target)
+    await app.dp.stop_polling()
+    await polling
+    await app.lifecycle.drain()
+
+async def start_webhook(app, public_url=None):
+    # runs the bot's webhook server on a free port until lifecycle.stopping
+    import aiohttp
+
+    app.lifecycle.stopping = asyncio.Event()
+    app.WEBHOOK_HOST, app.WEBHOOK_PORT, app.WEBHOOK_URL = "127.0.0.1", free_port(), public_url
+    server = asyncio.create_task(app.run_webhook())
+    url = f"http://127.0.0.1:{app.WEBHOOK_PORT}{app.WEBHOOK_PATH}"
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url):
+                    return server, url
+            except aiohttp.ClientConnectionError:
+                await asyncio.sleep(0.01)
+
+async def deliver_webhook(driver, updates, target):
+    import aiohttp
+
+    app = driver.app
+    server, url = await start_webhook(app)
+    async with aiohttp.ClientSession() as session:
+        limit = asyncio.Semaphore(50)
+
+        async def post(update):
+            async with limit, session.post(url, json=update) as resp:
+                resp.raise_for_status()
+
+        await asyncio.gather(*(post(update) for update in updates))
+    await wait_for_replies(driver.recorder, target)
+    app.lifecycle.stopping.set()
+    await server
+
+async def webhook_mode(args):
+    # the same synthetic chat updates delivered by long polling and by the
+    # webhook worker pool, timed until every reply has reached telegram and
+    # the handlers have finished
+    report = {}
+    for name, deliver in (("polling", deliver_polling), ("webhook", deliver_webhook)):
+        async with stack(args) as driver:
+            users = range(1, args.users + 1)
+            await asyncio.gather(*(driver.prepare(user_id, "chat") for user_id in users))
+            updates = [
+                driver.request(user_id, "chat", i) for i in range(args.messages) for user_id in users
+            ]
+            target = driver.recorder.sent + len(updates)
+            start = time.perf_counter()
+            await deliver(driver, updates, target)
+            elapsed = time.perf_counter() - start
+        report[name] = {
+            "updates": len(updates),
+            "elapsed_seconds": elapsed,
+            "throughput_ups": len(updates) / elapsed,
+        }
+    return report
+
+def https_stub(args, directory):
+    # a local tts endpoint behind a self-signed certificate, counting the
+    # tls connections it accepts
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-keyout", key, "-out", cert, "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1"],
+        check=True, capture_output=True,
+    )
+    server_ssl = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server_ssl.load_cert_chain(cert, key)
+    connections = set()
+
+    async def tts(request):
+        connections.add(request.transport)
+        await asyncio.sleep(args.latency)
+        return web.json_response({"url": "https://example.com/speech.mp3"})
+
+    app = web.Application()
+    app.router.add_post("/v1/audio/tts", tts)
+    return app, server_ssl, ssl.create_default_context(cafile=cert), connections
+
+async def http_mode(args):
+    # per request latency of the text to speech call over https, with a new
+    # session per request as generate_speech used to do and with the shared pool
+    import aiohttp
+
+    app = load_bot()
+    with tempfile.TemporaryDirectory() as directory:
+        stub, server_ssl, client_ssl, connections = https_stub(args, directory)
+        runner = web.AppRunner(stub)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0, ssl_context=server_ssl)
+        await site.start()
+        url = f"https://127.0.0.1:{runner.addresses[0][1]}/v1/audio/tts"
+        body = {"text": "hello", "voice_id": "pNInz6obpgDQGcFmaJgB"}
+
+        async def per_request():
+            async with aiohttp.ClientSession() as session:
+                async with session.post(url, json=body, ssl=client_ssl) as resp:
+                    await resp.read()
+
+        async def pooled():
+            await app.http_clients.request("POST", url, json=body, ssl=client_ssl)
+
+        report = {}
+        for name, call in (("per_request_session", per_request), ("shared_pool", pooled)):
+            connections.clear()
+            limit = asyncio.Semaphore(args.concurrency)
+            latencies = []
+
+            async def timed_call():
+                async with limit:
+                    start = time.perf_counter()
+                    await call()
+                    latencies.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            await asyncio.gather(*(timed_call() for _ in range(args.users)))
+            elapsed = time.perf_counter() - start
+            report[name] = {
+                "requests": len(latencies),
+                "connections": len(connections),
+                "throughput_rps": len(latencies) / elapsed,
+                "p50": percentile(latencies, 0.50),
+                "p95": percentile(latencies, 0.95),
+                "p99": percentile(latencies, 0.99),
+            }
+        await app.http_clients.close()
+        app.http_clients.session = None
+        await runner.cleanup()
+    return report
+
+MODES = {
+    "flows": flows_mode,
+    "http": http_mode,
+    "scaling": scaling_mode,
+    "ttft": ttft_mode,
+    "memory": memory_mode,
+    "long": long_mode,
+    "webhook": webhook_mode,
+}
+
+def parser():
+    parser = argparse.ArgumentParser(description="Offline load test for bot.py")
+    parser.add_argument("--mode", choices=sorted(MODES), default="flows")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=3, help="requests per user after picking a model")
+    parser.add_argument("--concurrency", type=int, default=200, help="users active at once")
+    parser.add_argument("--flows", default="chat,image,tts,vision")
+    parser.add_argument("--latency", type=float, default=0.2, help="mean upstream latency in seconds")
+    parser.add_argument("--tokens", type=int, default=20, help="tokens per chat answer")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="seconds between streamed tokens")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of upstream calls that fail")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="share of upstream calls 10x slower")
+    parser.add_argument(
+        "--endpoints", help="one fake upstream per LATENCY:ERROR_RATE[:SLOW_RATE], comma separated"
+    )
+    parser.add_argument("--hedge", action="store_true", help="turn on hedged requests")
+    parser.add_argument("--max-sessions", type=int, default=10000, help="session store cap in memory mode")
+    parser.add_argument("--retries", type=int, default=0, help="upstream retries the bot makes per call")
+    parser.add_argument("--shared-prompts", action="store_true", help="all users send the same prompts")
+    parser.add_argument("--no-stream", dest="stream", action="store_false")
+    parser.add_argument("--rate-limit", action="store_true", help="keep the per-user rate limits on")
+    parser.add_argument("--output", help="write the json report here as well")
+    return parser
+
+def options(**overrides):
+    args = parser().parse_args([])
+    vars(args).update(overrides)
+    return args
+
+async def main(args):
+    report = {"config": vars(args), **await MODES[args.mode](args)}
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as results_file:
+            results_file.write(output)
+    print(output)
+
+if __name__ == "__main__":
+    args = parser().parse_args()
+    random.seed(0)
+    asyncio.run(main(args))
@@ -0,0 +1,61 @@
+import asyncio
+import time
+
+import loadtest
+
+app = loadtest.load_bot()
+
+def test_exact_lookup_ignores_case_and_spacing():
+    cache = app.AnswerCache(10, 60, 1)
+    cache.store("gpt-4", "What is the capital of France?", "Paris", 2.0)
+    assert cache.lookup("gpt-4", "  what is the CAPITAL of france? ") == "Paris"
+    assert cache.lookup("gpt-3.5-turbo", "What is the capital of France?") is None
+    assert cache.lookup("gpt-4", "What is the capital of Spain?") is None
+    assert (cache.hits, cache.misses, cache.saved_seconds) == (1, 2, 2.0)
+
+def test_similar_lookup_respects_the_threshold():
+    cache = app.AnswerCache(10, 60, 0.8)
+    cache.store("gpt-4", "What is the capital of France?", "Paris", 1.0)
+    cache.store("gpt-4", "How do I sort a list in python?", "sorted()", 1.0)
+    assert cache.lookup("gpt-4", "what's the capital of france") == "Paris"
+    assert cache.lookup("gpt-4", "how do i sort a list in python") == "sorted()"
+    assert cache.lookup("gpt-4", "What is the population of France?") is None
+    assert cache.lookup("gpt-4", "Tell me a joke") is None
+
+def test_expired_and_evicted_entries_are_gone():
+    cache = app.AnswerCache(2, 60, 1)
+    for i in range(5):
+        cache.store("gpt-4", f"question number {i}", f"answer {i}", 1.0)
+    assert len(cache._entries) == 2
+    assert {key for keys in cache._index.values() for key in keys} == set(cache._entries)
+    assert cache.lookup("gpt-4", "question number 0") is None
+    cache.ttl = 0
+    cache.store("gpt-4", "short lived", "gone", 1.0)
+    time.sleep(0.01)
+    assert cache.lookup("gpt-4", "short lived") is None
+
+def test_repeated_first_questions_hit_the_cache():
+    async def scenario():
+        args = loadtest.options(latency=0.1, shared_prompts=True)
+        async with loadtest.stack(args) as driver:
+            app.CHAT_CACHE = True
+            try:
+                users = range(1, 11)
+                for user_id in users:
+                    await driver.prepare(user_id, "chat")
+                series = app.upstream_seconds.series.get(("gpt-4",), [None, 0.0])
+                upstream_before = series[1]
+                await driver.feed(driver.request(1, "chat", 0))
+                upstream = app.upstream_seconds.series[("gpt-4",)][1] - upstream_before
+                requests = driver.upstream["requests"]
+                await asyncio.gather(*(driver.feed(driver.request(user_id, "chat", 0)) for user_id in users[1:]))
+            finally:
+                app.CHAT_CACHE = False
+            assert driver.upstream["requests"] == requests
+            assert (app.answer_cache.hits, app.answer_cache.misses) == (9, 1)
+            # a hit saves the upstream time only, not the telegram sends around it
+            assert abs(app.answer_cache.saved_seconds - 9 * upstream) < 1e-6
+
+    app.answer_cache.hits = app.answer_cache.misses = 0
+    app.answer_cache.saved_seconds = 0.0
+    asyncio.run(scenario())
@@ -0,0 +1,58 @@
+import asyncio
+
+import loadtest
+
+def texts(driver, user_id):
+    return [text for (chat_id, _), text in driver.recorder.texts.items() if chat_id == user_id]
+
+def answer_texts(driver, user_id):
+    sent = texts(driver, user_id)
+    start = max(i for i, text in enumerate(sent) if text.startswith("You said:"))
+    return sent[start:]
+
+def long_answer(stream, tokens):
+    async def scenario():
+        args = loadtest.options(latency=0, token_delay=0, tokens=tokens, stream=stream)
+        async with loadtest.stack(args) as driver:
+            await driver.prepare(1, "chat")
+            await driver.feed(driver.message(1, text="write a lot"))
+            chunks = answer_texts(driver, 1)
+            answer = driver.app.user_states.get(1).conversation[-1]["content"]
+            assert len(answer) > tokens * 5
+            assert len(chunks) > 1
+            assert all(len(chunk) <= driver.app.TELEGRAM_LIMIT for chunk in chunks)
+            assert " ".join(chunks).split() == answer.split()
+
+    asyncio.run(scenario())
+
+def test_multi_megabyte_answer_is_sent_in_order():
+    long_answer(False, 400000)
+
+def test_long_streamed_answer_is_sent_in_order():
+    long_answer(True, 40000)
+
+def test_concurrent_exports_get_their_own_document():
+    async def scenario():
+        args = loadtest.options(latency=0.05, token_delay=0, tokens=50000, stream=False)
+        async with loadtest.stack(args) as driver:
+            users = range(1, 21)
+            for user_id in users:
+                await driver.prepare(user_id, "chat")
+            await asyncio.gather(
+                *(driver.feed(driver.message(user_id, text=f"question {user_id} file:md")) for user_id in users)
+            )
+            for user_id in users:
+                [(filename, document)] = driver.recorder.documents[user_id]
+                answer = driver.app.user_states.get(user_id).conversation[-1]["content"]
+                assert filename == "file.md"
+                assert document.decode() == answer
+                assert answer.startswith(f"You said: question {user_id} . ")
+
+    asyncio.run(scenario())
+
+def test_a_stray_less_than_does_not_shorten_chunks():
+    app = loadtest.load_bot()
+    for text in ("if a < b then " + "lorem ipsum " * 1000, "for (i = 0; i<n; i++) x += i;\n" * 500):
+        chunks = list(app.split_message(text))
+        assert all(len(chunk) > app.TELEGRAM_LIMIT // 2 for chunk in chunks[:-1])
+        assert "".join(chunks) == text
@@ -0,0 +1,29 @@
+import asyncio
+import json
+
+import loadtest
+
+app = loadtest.load_bot()
+
+def scrape():
+    return "\n".join(line for metric in app.metrics for line in metric.render())
+
+def test_a_full_log_queue_drops_without_blocking(tmp_path, monkeypatch):
+    async def scenario():
+        monkeypatch.setattr(app, "LOG_FILE", str(tmp_path / "users.log"))
+        monkeypatch.setattr(app, "log_queue", asyncio.Queue(3))
+        dropped = app.log_dropped
+        for i in range(10):
+            await asyncio.wait_for(app.logme(f"user{i}", "gpt-4", f"message {i}"), 0.1)
+        assert app.log_queue.qsize() == 3
+        assert app.log_dropped - dropped == 7
+        assert f"bot_log_dropped_total {app.log_dropped}" in scrape()
+
+        await app.flush_logs()
+        with open(tmp_path / "users.log") as log_file:
+            assert [json.loads(line)["text"] for line in log_file] == ["message 0", "message 1", "message 2"]
+        # the counter is cumulative, flushing does not reset it
+        assert app.log_dropped - dropped == 7
+        assert app.log_dropped_reported == app.log_dropped
+
+    asyncio.run(scenario())
@@ -0,0 +1,21 @@
+import asyncio
+
+import loadtest
+
+def test_one_users_messages_are_answered_in_turn():
+    async def scenario():
+        async with loadtest.stack(loadtest.options(latency=0.1, stream=False)) as driver:
+            await driver.prepare(1, "chat")
+            driver.recorder.texts.clear()
+            await asyncio.gather(
+                driver.feed(driver.message(1, text="first")),
+                driver.feed(driver.message(1, text="second")),
+            )
+            replies = [text.split(". ", 1)[0] for text in driver.recorder.texts.values()]
+            assert replies == ["You said: first", "You said: second"]
+            conversation = driver.app.user_states.get(1).conversation
+            roles = [m["role"] for m in conversation if m["role"] != "system"]
+            assert roles[-4:] == ["user", "assistant", "user", "assistant"]
+            assert [m["content"] for m in conversation if m["role"] == "user"][-2:] == ["first", "second"]
+
+    asyncio.run(scenario())
@@ -0,0 +1,82 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+import loadtest
+
+REJECTED = "Too many requests"
+
+def texts(driver, user_id):
+    return [text for (chat_id, _), text in driver.recorder.texts.items() if chat_id == user_id]
+
+async def burst(driver, user_id, count):
+    async def send(i):
+        start = time.perf_counter()
+        await driver.feed(driver.message(user_id, text=f"burst {i} from {user_id}"))
+        return time.perf_counter() - start
+
+    return sorted(await asyncio.gather(*(send(i) for i in range(count))))
+
+@asynccontextmanager
+async def limited(rate, queue_size=20, max_wait=10):
+    args = loadtest.options(rate_limit=True, latency=0.01, stream=False, tokens=2, token_delay=0)
+    async with loadtest.stack(args) as driver:
+        limiter = driver.app.rate_limiter
+        saved = limiter.queue_size, limiter.max_wait
+        limiter.rates["chat"] = rate
+        limiter.queue_size, limiter.max_wait = queue_size, max_wait
+        limiter.rejected["chat"] = 0
+        try:
+            yield driver
+        finally:
+            limiter.queue_size, limiter.max_wait = saved
+
+def test_a_burst_is_delayed_then_rejected_past_the_max_wait():
+    async def scenario():
+        async with limited(rate=(60, 2), max_wait=1.5) as driver:
+            limiter = driver.app.rate_limiter
+            for user_id in (1, 2):
+                await driver.prepare(user_id, "chat")
+            driver.recorder.texts.clear()
+            peak = 0
+
+            async def watch():
+                nonlocal peak
+                while True:
+                    peak = max(peak, limiter.waiting["chat"])
+                    await asyncio.sleep(0.01)
+
+            watcher = asyncio.create_task(watch())
+            # one token a second and a burst of two: two answers at once, one
+            # a second later and the fourth would wait two seconds
+            heavy, light = await asyncio.gather(burst(driver, 1, 4), burst(driver, 2, 2))
+            watcher.cancel()
+            answers = texts(driver, 1)
+            assert sum(text.startswith(REJECTED) for text in answers) == 1
+            assert sum(text.startswith("You said: ") for text in answers) == 3
+            assert heavy[2] < 0.5 and heavy[-1] > 0.9
+            assert limiter.rejected["chat"] == 1
+            assert peak == 1 and limiter.waiting["chat"] == 0
+            # the other user has a bucket of their own
+            assert max(light) < 0.5
+            assert all(text.startswith("You said: ") for text in texts(driver, 2))
+
+    asyncio.run(scenario())
+
+def test_requests_past_the_queue_size_are_rejected():
+    async def scenario():
+        async with limited(rate=(60, 1), queue_size=2) as driver:
+            limiter = driver.app.rate_limiter
+            users = range(1, 5)
+            for user_id in users:
+                await driver.prepare(user_id, "chat")
+            driver.recorder.texts.clear()
+            await asyncio.gather(*(burst(driver, user_id, 2) for user_id in users))
+            # every first message is answered, only two second ones fit in the queue
+            for user_id in users:
+                assert any(text.startswith(f"You said: burst 0 from {user_id}") for text in texts(driver, user_id))
+            rejected = [text for user_id in users for text in texts(driver, user_id) if text.startswith(REJECTED)]
+            assert len(rejected) == limiter.rejected["chat"] == 2
+            assert limiter.waiting["chat"] == 0
+
+    asyncio.run(scenario())
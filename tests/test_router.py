@@ -0,0 +1,67 @@
+import asyncio
+import random
+
+import loadtest
+
+CALLS = 200
+
+async def ask(app, i):
+    response = await app.chat_completion(
+        model="gpt-4", messages=[{"role": "user", "content": f"question {i}"}]
+    )
+    return response.choices[0].message.content
+
+def test_traffic_moves_off_a_failing_endpoint():
+    async def scenario():
+        args = loadtest.options(endpoints="0.01:1,0.01:0", stream=False, tokens=2, token_delay=0)
+        async with loadtest.stack(args) as driver:
+            app = driver.app
+            failing, healthy = app.upstream.endpoints
+            answers = [await ask(app, i) for i in range(20)]
+            assert all(answer.startswith("You said: ") for answer in answers)
+            assert failing.error_rate > 0 and healthy.error_rate == 0
+            assert failing.score() > healthy.score()
+            failed, served = (server["served"] for server in driver.servers)
+            assert failed["faults"] == failed["requests"] <= 2
+            assert served["requests"] == 20
+
+    asyncio.run(scenario())
+
+def test_retries_recover_from_faults():
+    async def scenario():
+        args = loadtest.options(error_rate=0.2, retries=4, stream=False, tokens=2, token_delay=0, latency=0.01)
+        async with loadtest.stack(args) as driver:
+            answers = [await ask(driver.app, i) for i in range(20)]
+            assert all(answer.startswith("You said: ") for answer in answers)
+            assert driver.upstream["retries"] == driver.upstream["faults"] > 0
+
+    random.seed(0)
+    asyncio.run(scenario())
+
+def test_hedges_are_capped_and_hold_no_slot():
+    async def scenario():
+        args = loadtest.options(
+            endpoints="0.01:0:0.1,0.01:0:0.1", hedge=True, stream=False, tokens=2, token_delay=0
+        )
+        async with loadtest.stack(args) as driver:
+            app = driver.app
+            rate, app.upstream.max_hedge_rate = app.upstream.max_hedge_rate, 0.05
+            free = app.scheduler.free
+            limit = asyncio.Semaphore(4)
+
+            async def call(i):
+                async with limit:
+                    return await ask(app, i)
+
+            try:
+                answers = await asyncio.gather(*(call(i) for i in range(CALLS)))
+                await asyncio.sleep(0.2)
+            finally:
+                app.upstream.max_hedge_rate = rate
+            assert all(answer.startswith("You said: ") for answer in answers)
+            assert 0 < app.upstream.hedges <= CALLS * 0.05 + 1
+            # a hedge cancelled while connecting never reaches the server
+            assert CALLS <= driver.upstream["requests"] <= CALLS + app.upstream.hedges
+            assert app.scheduler.free == free
+
+    asyncio.run(scenario())
@@ -0,0 +1,101 @@
+import asyncio
+
+import loadtest
+
+app = loadtest.load_bot()
+
+async def until(condition):
+    while not condition():
+        await asyncio.sleep(0.01)
+
+def backlog(scheduler, jobs, served, queued=None):
+    # queues every job behind a held slot, then frees it
+    async def job(user_id, workload):
+        app.current_user.set(user_id)
+        async with scheduler.slot(workload):
+            served.append((workload, user_id))
+            await asyncio.sleep(0)
+
+    assert scheduler.try_acquire()
+    tasks = [asyncio.create_task(job(user_id, workload)) for user_id, workload in jobs]
+
+    async def run():
+        await until(lambda: sum(map(len, scheduler.queues.values())) == len(jobs))
+        if queued is not None:
+            await queued()
+        scheduler.release()
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    return run()
+
+def test_workloads_share_by_weight():
+    async def scenario():
+        scheduler = app.JobScheduler(1, {"chat": 4, "image": 1}, 60)
+        served = []
+        jobs = [(i, "chat") for i in range(20)] + [(100 + i, "image") for i in range(20)]
+        await backlog(scheduler, jobs, served)
+        workloads = [workload for workload, _ in served]
+        assert workloads[:20].count("chat") == 16
+        assert workloads[:20].count("image") == 4
+        # once chat runs out the images get every slot
+        assert workloads[-15:] == ["image"] * 15
+
+    asyncio.run(scenario())
+
+def test_admins_are_served_before_free_users():
+    async def scenario():
+        scheduler = app.JobScheduler(1, {"chat": 1}, 60)
+        served = []
+        app.ADMIN_USERS.add(100)
+        try:
+            await backlog(scheduler, [(1, "chat"), (2, "chat"), (100, "chat"), (3, "chat")], served)
+        finally:
+            app.ADMIN_USERS.discard(100)
+        assert [user_id for _, user_id in served] == [100, 1, 2, 3]
+
+    asyncio.run(scenario())
+
+def test_finished_and_expired_jobs_are_dropped():
+    async def scenario():
+        scheduler = app.JobScheduler(1, {"chat": 1}, 0.05)
+        for user_id in (1, 2):
+            app.user_states.reset(user_id)
+        served = []
+
+        async def finish_one():
+            app.user_states.reset(1)
+            await asyncio.sleep(0.1)
+
+        results = await backlog(scheduler, [(1, "chat"), (2, "chat")], served, finish_one)
+        # user 1 finished the dialogue, user 2 waited past the deadline
+        assert served == []
+        assert [(type(e), e.finished) for e in results] == [(app.JobDropped, True), (app.JobDropped, False)]
+        assert scheduler.dropped["chat"] == 2 and scheduler.free == 1
+
+    asyncio.run(scenario())
+
+def test_an_expired_job_gets_the_busy_reply():
+    async def scenario():
+        async with loadtest.stack(loadtest.options(latency=0.01, stream=False)) as driver:
+            scheduler = driver.app.scheduler
+            await driver.prepare(1, "chat")
+            driver.recorder.texts.clear()
+            held = 0
+            while scheduler.try_acquire():
+                held += 1
+            deadline, scheduler.deadline = scheduler.deadline, 0.05
+            try:
+                reply = asyncio.create_task(driver.feed(driver.message(1, text="anyone there?")))
+                await until(lambda: scheduler.queues["chat"])
+                await asyncio.sleep(0.1)
+                for _ in range(held):
+                    scheduler.release()
+                await reply
+            finally:
+                scheduler.deadline = deadline
+            assert list(driver.recorder.texts.values()) == [
+                "The bot is busy right now, please try again in a moment."
+            ]
+            assert driver.upstream["requests"] == 0
+
+    asyncio.run(scenario())
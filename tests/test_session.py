@@ -0,0 +1,45 @@
+import asyncio
+
+import loadtest
+
+TURNS = 200
+
+def test_history_stays_within_the_context_over_hundreds_of_turns():
+    async def scenario():
+        args = loadtest.options(latency=0, token_delay=0, tokens=200, stream=False)
+        async with loadtest.stack(args) as driver:
+            app = driver.app
+            await driver.prepare(1, "chat")
+            session = app.user_states.get(1)
+            budget = app.context_budget(session.model)
+            count_tokens = app.count_tokens
+            counted = []
+            app.count_tokens = lambda message: counted.append(message) or count_tokens(message)
+            sizes = []
+            try:
+                for turn in range(TURNS):
+                    sent = driver.upstream["bytes"]
+                    await driver.feed(driver.request(1, "chat", turn))
+                    sizes.append(driver.upstream["bytes"] - sent)
+                    assert session.token_total == sum(session.tokens) <= budget
+                    assert len(session.tokens) == len(session.conversation)
+                    question, answer = session.conversation[-2:]
+                    assert question["content"] == f"message number {turn} from user 1"
+                    assert answer["content"].startswith(f"You said: {question['content']}. ")
+            finally:
+                app.count_tokens = count_tokens
+            # every message is counted once, when it is added
+            assert len(counted) == 2 * TURNS
+            # only the longer turn numbers in the prompts still add a few bytes
+            assert max(sizes[TURNS // 4:]) <= max(sizes[:TURNS // 4]) * 1.01
+
+    asyncio.run(scenario())
+
+def test_a_message_over_the_budget_is_still_kept():
+    app = loadtest.load_bot()
+    session = app.Session("gpt-4")
+    session.add({"role": "user", "content": "short"})
+    huge = {"role": "user", "content": "x" * 4 * (app.context_budget("gpt-4") + 100)}
+    session.add(huge)
+    assert session.conversation == [huge]
+    assert session.token_total == sum(session.tokens)
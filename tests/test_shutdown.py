@@ -0,0 +1,51 @@
+import asyncio
+
+import aiohttp
+
+import loadtest
+
+USERS = 20
+
+def answered(driver):
+    return {text.split(". ", 1)[0] for text in driver.recorder.texts.values() if text.startswith("You said: ")}
+
+async def post(session, url, update):
+    # telegram redelivers an update that was not acknowledged with a 2xx
+    try:
+        async with session.post(url, json=update) as resp:
+            return resp.status == 200
+    except aiohttp.ClientConnectionError:
+        return False
+
+def test_rolling_deploy_drops_no_update():
+    async def scenario():
+        async with loadtest.stack(loadtest.options(latency=0.3, stream=False)) as driver:
+            app = driver.app
+            users = range(1, USERS + 1)
+            for user_id in users:
+                await driver.prepare(user_id, "chat")
+            first = [driver.request(user_id, "chat", 0) for user_id in users]
+            second = [driver.request(user_id, "chat", 1) for user_id in users]
+            sent = {update["message"]["text"] for update in first + second}
+
+            old, url = await loadtest.start_webhook(app)
+            async with aiohttp.ClientSession() as session:
+                assert all(await asyncio.gather(*(post(session, url, update) for update in first)))
+                # the deploy stops the old instance while its handlers are still waiting upstream
+                app.lifecycle.stopping.set()
+                accepted = await asyncio.gather(*(post(session, url, update) for update in second))
+            await old
+            assert app.lifecycle.cancelled == 0
+
+            new, url = await loadtest.start_webhook(app)
+            async with aiohttp.ClientSession() as session:
+                redelivered = [update for update, ok in zip(second, accepted) if not ok]
+                assert all(await asyncio.gather(*(post(session, url, update) for update in redelivered)))
+            await loadtest.wait_for_replies(driver.recorder, driver.recorder.sent + len(redelivered))
+            app.lifecycle.stopping.set()
+            await new
+
+            assert answered(driver) == {"You said: " + text for text in sent}
+            assert not driver.recorder.errors
+
+    asyncio.run(scenario())
@@ -0,0 +1,49 @@
+import asyncio
+
+import loadtest
+
+USERS = 30
+
+async def until(condition):
+    while not condition():
+        await asyncio.sleep(0.01)
+
+def test_identical_requests_make_one_upstream_call():
+    async def scenario():
+        async with loadtest.stack(loadtest.options(latency=0.2, shared_prompts=True)) as driver:
+            users = range(1, USERS + 1)
+            for user_id in users:
+                await driver.prepare(user_id, "image")
+                driver.recorder.arm(user_id)
+            requests = driver.upstream["requests"]
+            await asyncio.gather(*(driver.feed(driver.request(user_id, "image", 0)) for user_id in users))
+            assert driver.upstream["requests"] - requests == 1
+            assert set(driver.recorder.first) == set(users)
+            assert not driver.recorder.errors
+
+    asyncio.run(scenario())
+
+def test_one_waiter_finishing_does_not_drop_the_shared_call():
+    async def scenario():
+        async with loadtest.stack(loadtest.options(latency=0.05, shared_prompts=True)) as driver:
+            app = driver.app
+            users = range(1, 4)
+            for user_id in users:
+                await driver.prepare(user_id, "image")
+                driver.recorder.arm(user_id)
+            # every upstream slot is busy, so the shared call waits in the queue
+            held = 0
+            while app.scheduler.try_acquire():
+                held += 1
+            requests = [
+                asyncio.create_task(driver.feed(driver.request(user_id, "image", 0))) for user_id in users
+            ]
+            await until(lambda: app.scheduler.queues["image"])
+            await driver.feed(driver.message(1, text="Finish Dialogue"))
+            for _ in range(held):
+                app.scheduler.release()
+            await asyncio.gather(*requests)
+            assert {2, 3} <= set(driver.recorder.first)
+            assert not driver.recorder.errors
+
+    asyncio.run(scenario())
@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+
+import loadtest
+
+app = loadtest.load_bot()
+
+def sqlite_backend(tmp_path):
+    return app.SqliteBackend(str(tmp_path / "sessions.db"))
+
+def redis_backend(tmp_path):
+    fakeredis = pytest.importorskip("fakeredis")
+    backend = app.RedisBackend("redis://localhost:6379/0")
+    backend.redis = fakeredis.aioredis.FakeRedis()
+    return backend
+
+backends = pytest.mark.parametrize("make_backend", [sqlite_backend, redis_backend])
+
+def chat(store, user_id, text):
+    session = store.get(user_id) or store.reset(user_id)
+    session.model = "gpt-4"
+    session.add({"role": "user", "content": text}, {"role": "assistant", "content": "answer to " + text})
+    store.mark_dirty(user_id)
+
+@backends
+def test_sessions_survive_a_restart(tmp_path, make_backend):
+    async def scenario():
+        backend = make_backend(tmp_path)
+        store = app.SessionStore(10, 3600, backend)
+        chat(store, 1, "first")
+        chat(store, 1, "second")
+        await store.flush()
+
+        restarted = app.SessionStore(10, 3600, backend)
+        assert restarted.get(1) is None
+        await restarted.load(1)
+        session = restarted.get(1)
+        assert session.model == "gpt-4"
+        assert [m["content"] for m in session.conversation] == [
+            "first", "answer to first", "second", "answer to second"
+        ]
+        await backend.close()
+
+    asyncio.run(scenario())
+
+@backends
+def test_sessions_evicted_before_a_flush_are_written(tmp_path, make_backend):
+    async def scenario():
+        backend = make_backend(tmp_path)
+        store = app.SessionStore(1, 3600, backend)
+        chat(store, 1, "from one")
+        chat(store, 2, "from two")
+        assert store.get(1) is None
+        await store.flush()
+        assert (await backend.load(1))["conversation"][0]["content"] == "from one"
+        await backend.close()
+
+    asyncio.run(scenario())
+
+class FlakyBackend:
+    def __init__(self, backend):
+        self.backend = backend
+        self.failures = 1
+
+    async def load(self, user_id):
+        return await self.backend.load(user_id)
+
+    async def save_many(self, sessions):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("disk full")
+        await self.backend.save_many(sessions)
+
+def test_failed_flush_keeps_the_batch(tmp_path):
+    async def scenario():
+        backend = sqlite_backend(tmp_path)
+        store = app.SessionStore(1, 3600, FlakyBackend(backend))
+        chat(store, 1, "from one")
+        chat(store, 2, "from two")
+        with pytest.raises(OSError):
+            await store.flush()
+        await store.flush()
+        assert (await backend.load(1))["conversation"][0]["content"] == "from one"
+        assert (await backend.load(2))["conversation"][0]["content"] == "from two"
+        await backend.close()
+
+    asyncio.run(scenario())
+
+@backends
+def test_fsm_state_and_data_persist(tmp_path, make_backend):
+    async def scenario():
+        backend = make_backend(tmp_path)
+        key = StorageKey(bot_id=1, chat_id=2, user_id=2)
+        state = FSMContext(app.WriteBehindStorage(backend), key)
+        await state.set_state(app.ImagePrompt.waiting_for_text)
+        await state.update_data(prompt="a cat")
+        # handlers only touch memory, the backend sees nothing until a flush
+        assert await backend.load_fsm(state.storage._key(key)) is None
+        await state.storage.flush()
+
+        restarted = FSMContext(app.WriteBehindStorage(backend), key)
+        assert await restarted.get_state() == app.ImagePrompt.waiting_for_text.state
+        assert await restarted.get_data() == {"prompt": "a cat"}
+        await restarted.clear()
+        await restarted.storage.flush()
+        assert await backend.load_fsm(restarted.storage._key(key)) is None
+        await backend.close()
+
+    asyncio.run(scenario())
+
+@backends
+def test_image_flow_with_write_behind_fsm(tmp_path, make_backend):
+    async def scenario():
+        async with loadtest.stack(loadtest.options(latency=0.01)) as driver:
+            backend = make_backend(tmp_path)
+            storage = driver.app.dp.fsm.storage
+            driver.app.dp.fsm.storage = app.WriteBehindStorage(backend)
+            try:
+                results = {"image": {"reply": [], "complete": [], "errors": 0}}
+                await driver.run_user(1, "image", 2, results)
+            finally:
+                driver.app.dp.fsm.storage = storage
+                await backend.close()
+            assert results["image"]["errors"] == 0
+            assert len(results["image"]["reply"]) == 2
+
+    asyncio.run(scenario())
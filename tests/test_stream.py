@@ -0,0 +1,41 @@
+import asyncio
+
+import loadtest
+
+def chat_message(driver, user_id):
+    raw = driver.message(user_id, text="hi")["message"]
+    return driver.app.types.Message.model_validate(raw, context={"bot": driver.app.bot})
+
+def test_whitespace_pieces_do_not_break_the_reply():
+    async def scenario():
+        async with loadtest.stack(loadtest.options()) as driver:
+            app = driver.app
+            app.STREAM_EDIT_INTERVAL = 0
+
+            async def pieces():
+                for piece in ("Hello", " ", "\n\n", "world", " ", "\n"):
+                    yield piece
+
+            answer = await app.stream_reply(chat_message(driver, 1), pieces())
+            assert answer == "Hello \n\nworld \n"
+            assert list(driver.recorder.texts.values()) == ["Hello \n\nworld"]
+
+    asyncio.run(scenario())
+
+def test_long_stream_is_split_into_messages():
+    async def scenario():
+        async with loadtest.stack(loadtest.options()) as driver:
+            app = driver.app
+            app.STREAM_EDIT_INTERVAL = 0
+
+            async def pieces():
+                for i in range(2000):
+                    yield f"word{i} "
+
+            answer = await app.stream_reply(chat_message(driver, 1), pieces())
+            texts = list(driver.recorder.texts.values())
+            assert len(texts) > 1
+            assert all(len(text) <= app.TELEGRAM_LIMIT for text in texts)
+            assert " ".join(texts).split() == answer.split()
+
+    asyncio.run(scenario())
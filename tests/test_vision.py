@@ -0,0 +1,49 @@
+import asyncio
+
+import loadtest
+
+USERS = 40
+
+def replies(driver, user_id):
+    return [text for (chat_id, _), text in driver.recorder.texts.items() if chat_id == user_id]
+
+def test_concurrent_vision_requests_answer_about_their_own_photo():
+    async def scenario():
+        async with loadtest.stack(loadtest.options(latency=0.05)) as driver:
+            users = range(1, USERS + 1)
+            for user_id in users:
+                await driver.prepare(user_id, "vision")
+                if user_id % 2:
+                    await driver.feed(driver.callback(user_id, "llava-13b"))
+            driver.recorder.texts.clear()
+            await asyncio.gather(
+                *(driver.feed(driver.request(user_id, "vision", 0)) for user_id in users)
+            )
+            for user_id in users:
+                answers = [text for text in replies(driver, user_id) if text.startswith("I see ")]
+                assert answers == [f"I see photos/photo{user_id}.jpg. " + answers[0].split(". ", 1)[1]]
+
+            # the photo is not kept in the history, a follow up still gets an answer
+            for user_id in users:
+                session = driver.app.user_states.get(user_id)
+                assert "data:" not in str(session.conversation)
+                assert "[image]" in str(session.conversation)
+            driver.recorder.texts.clear()
+            await asyncio.gather(
+                *(driver.feed(driver.message(user_id, text="and now?")) for user_id in users)
+            )
+            for user_id in users:
+                assert replies(driver, user_id)
+                assert not any(text.startswith("Error") for text in replies(driver, user_id))
+
+    asyncio.run(scenario())
+
+def test_inline_images_count_by_size():
+    app = loadtest.load_bot()
+    url = "data:image/jpeg;base64," + "A" * 60000
+    message = {"role": "user", "content": [{"type": "image_url", "image_url": url}]}
+    assert app.count_tokens(message) >= 15000
+    stored = app.stored_message(message)
+    assert app.count_tokens(stored) < 100
+    remote = {"role": "user", "content": [{"type": "image_url", "image_url": "https://i.ibb.co/x.jpg"}]}
+    assert app.stored_message(remote) == remote
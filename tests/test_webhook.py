@@ -0,0 +1,30 @@
+import asyncio
+import json
+
+import aiohttp
+
+import loadtest
+
+def test_unknown_update_types_are_acknowledged():
+    async def scenario():
+        async with loadtest.stack(loadtest.options(latency=0.01, stream=False)) as driver:
+            app = driver.app
+            await driver.prepare(1, "chat")
+            server, url = await loadtest.start_webhook(app, "https://bot.example.com")
+            try:
+                allowed = json.loads(driver.recorder.webhook["allowed_updates"])
+                assert set(allowed) == set(app.dp.resolve_used_update_types())
+                assert "message" in allowed and "callback_query" in allowed
+                async with aiohttp.ClientSession() as session:
+                    unknown = {"update_id": 10 ** 6, "business_message": {"message_id": 1}}
+                    async with session.post(url, json=unknown) as resp:
+                        assert resp.status == 200
+                    async with session.post(url, json=driver.request(1, "chat", 0)) as resp:
+                        assert resp.status == 200
+                await loadtest.wait_for_replies(driver.recorder, driver.recorder.sent + 1)
+            finally:
+                app.lifecycle.stopping.set()
+                await server
+            assert any(text.startswith("You said: message number 0") for text in driver.recorder.texts.values())
+
+    asyncio.run(scenario())